@@ -1,486 +1,657 @@
+import aiofiles
+import asyncio
+import hashlib
+import httpx
+import io
 import litellm
-import json
-from typing import Dict, List
-from .search_tools import search_products_by_text, search_products_by_photo, generate_payment_url
+import orjson
+from cachetools import TTLCache
+import os
+import random
+import re
+import sys
+import tiktoken
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from pathlib import Path
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional
+from .context_store import create_context_store
+from .first_message_cache import FirstMessageCache
 from .logger_config import get_logger
 
+# Models used for conversation turns: simple turns are routed to the cheaper model
+DEFAULT_MODEL = "gpt-4o"
+LIGHT_MODEL = "gpt-4o-mini"
+SIMPLE_MESSAGE_MAX_LENGTH = 40
+RECENT_CONTEXT_WINDOW = 6
+PHONE_NUMBER_PATTERN = re.compile(r"\+?\d[\d\s()-]{7,}\d")
+
+# Maximum number of LLM requests in flight across all users; bursts queue up here
+# instead of hitting the provider's rate limit
+MAX_CONCURRENT_LLM_REQUESTS = int(os.getenv("LLM_MAX_CONCURRENCY", "20"))
+
+# Keep-alive connection pool shared by all LiteLLM calls
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 100
+HTTP_MAX_CONNECTIONS = 200
+
+# Maximum number of messages kept per user (~10 user/assistant pairs plus tool messages)
+MAX_CONTEXT_MESSAGES = 20
+
+# Tool results from turns older than the last N user messages are elided from the prompt
+TOOL_RESULT_KEEP_TURNS = 2
+ELIDED_TOOL_RESULT = "[previous search results elided]"
+
+# Maximum tokens of conversation history sent with each request (system prompt not included)
+CONTEXT_TOKEN_BUDGET = 4000
+
+# Transient provider errors are retried this many times per model before falling back
+LLM_MAX_RETRIES = 3
+LLM_RETRY_BASE_DELAY = 0.5
+FALLBACK_MODELS = [LIGHT_MODEL]
+RETRYABLE_LLM_ERRORS = (
+    litellm.exceptions.RateLimitError,
+    litellm.exceptions.APIConnectionError,
+    litellm.exceptions.Timeout,
+    litellm.exceptions.InternalServerError,
+    litellm.exceptions.ServiceUnavailableError,
+)
+
+# Voice transcription models, tried in order when one is rate limited
+TRANSCRIPTION_MODELS = ["gpt-4o-mini-transcribe", "whisper-1"]
+
+# Final (non tool-call) LLM responses are cached for identical prompts
+LLM_CACHE_TTL_SECONDS = 3600
+LLM_CACHE_MAX_SIZE = 1000
+
+# Searches run in their own bounded thread pool, so a burst of them can't take every worker
+# of the default executor that file I/O and other blocking calls share
+SEARCH_WORKERS = max(4, os.cpu_count() or 1)
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+# Text search results are reused for identical arguments for a few minutes
+# (queries differing only in case or spacing count as identical)
+TOOL_CACHE_TTL_SECONDS = 300
+TOOL_CACHE_MAX_SIZE = 512
+QUERY_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+# Links in a checkout summary; ones that aren't real URLs (placeholders written before the
+# payment tool returned) or that point at a payment page other than the generated one are unwrapped
+ANCHOR_PATTERN = re.compile(r'<a\s+href="([^"]*)"[^>]*>(.*?)</a>', re.DOTALL)
+PAYMENT_HOST = "my.click.uz"
+
+# Link line appended to the checkout summary the model wrote alongside a payment tool call
+# (no follow-up LLM call needed). It has no words, so it fits whatever language the summary is in
+PAYMENT_REPLY_TEMPLATE = '💳 <a href="{payment_url}">{price} uzs</a>'
+
+# Reply when the tool loop hits its iteration limit without the model writing anything, in the
+# customer's language: Kazakh-only letters mean Kazakh, other Cyrillic Russian, o‘/g‘ Uzbek Latin,
+# anything else the bot's default language
+MAX_ITERATIONS_REPLIES = {
+    "en": "I've reached the maximum number of search attempts. Let me know a bit more about what you're looking for and I'll find the best options 💐",
+    "ru": "Я перебрала много вариантов, но пока не нашла идеального. Расскажите чуть подробнее, что вы ищете, и я подберу лучшие букеты 💐",
+    "kk": "Мен көп нұсқаны қарап шықтым, бірақ әзірге мінсізін таппадым. Не іздеп жүргеніңізді сәл толығырақ айтыңызшы, ең жақсы гүл шоқтарын таңдап беремін 💐",
+    "uz": "Ko‘p variantlarni ko‘rib chiqdim, lekin hali eng mosini topmadim. Nima qidirayotganingizni biroz batafsilroq aytib bering, eng yaxshi guldastalarni tanlab beraman 💐",
+}
+KAZAKH_LETTERS_PATTERN = re.compile(r"[әғқңөұүһі]", re.IGNORECASE)
+CYRILLIC_PATTERN = re.compile(r"[а-яё]", re.IGNORECASE)
+UZBEK_LATIN_PATTERN = re.compile(r"[og][‘ʻ]", re.IGNORECASE)
+
+# System prompt loaded once at import and kept as a constant so it is byte-identical on every
+# turn and served from the provider's prompt cache
+SYSTEM_PROMPT = sys.intern((Path(__file__).parent / "prompts" / "lola_system.txt").read_text(encoding="utf-8"))
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# OpenAI caches identical prompt prefixes automatically; one shared prompt_cache_key routes every
+# user's turns (and the startup warm-up) to the same cache, so all of them reuse the system-prompt prefix
+PROMPT_CACHE_KEY = "lola-v1"
+
+# Function calling schema for tools format, shared by all agent instances
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_products_by_text",
+            "description": "Search for bouquets using text query with optional filters",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query_text": {
+                        "type": "string",
+                        "description": "Text query describing what the customer is looking for"
+                    },
+                    "document_type": {
+                        "type": "string",
+                        "enum": ["text", "photo"],
+                        "description": "Type of document to search in"
+                    },
+                    "min_price": {
+                        "type": "number",
+                        "description": "Minimum price filter"
+                    },
+                    "max_price": {
+                        "type": "number", 
+                        "description": "Maximum price filter"
+                    },
+                    "k": {
+                        "type": "integer",
+                        "description": "Number of results to return (max 3)"
+                    }
+                },
+                "required": ["query_text"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_products_by_photo",
+            "description": "Search for bouquets using an uploaded photo with optional filters",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "min_price": {
+                        "type": "number",
+                        "description": "Minimum price filter"
+                    },
+                    "max_price": {
+                        "type": "number",
+                        "description": "Maximum price filter"
+                    },
+                    "k": {
+                        "type": "integer",
+                        "description": "Number of results to return (max 3)"
+                    }
+                },
+                "required": []
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "generate_payment_link",
+            "description": "Generate a payment link for a specific product when customer wants to buy",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "price": {
+                        "type": "number",
+                        "description": "Price of the product in the smallest currency units"
+                    }
+                },
+                "required": ["price"]
+            }
+        }
+    }
+]
+
+
+
+@lru_cache(maxsize=None)
+def _search_tools():
+    """Import search_tools on first use (its models and index load on their first use in turn)."""
+    from . import search_tools
+    return search_tools
+
+
+# gpt-4o tokenizer, loaded by warm_up in a worker thread (the first load downloads the BPE file).
+# Until it is loaded, or if loading fails, token counts are estimated from the text length
+_token_encoding = None
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+
+def _load_tokenizer():
+    """Load the gpt-4o tokenizer and drop the token counts estimated without it."""
+    global _token_encoding
+    _token_encoding = tiktoken.get_encoding("o200k_base")
+    _count_tokens.cache_clear()
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text: Optional[str]) -> int:
+    """Count tokens in a message's content (memoized, history is re-counted every turn)."""
+    if not text:
+        return 0
+    if _token_encoding is None:
+        return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+    return len(_token_encoding.encode(text))
+
+
+def _call_search_tool(name: str, kwargs: Dict):
+    return getattr(_search_tools(), name)(**kwargs)
+
+
+async def _run_search_tool(name: str, **kwargs):
+    """Call a search_tools function by name in the search thread pool (so the first import doesn't block the loop either)."""
+    return await asyncio.get_running_loop().run_in_executor(_search_executor, partial(_call_search_tool, name, kwargs))
+
 class AISellerAgent:
+    tools = TOOLS
+
+    # Fixed attribute layout: no per-instance __dict__
+    __slots__ = (
+        "logger",
+        "openai_api_key",
+        "default_language",
+        "context_store",
+        "_llm_cache",
+        "_inflight",
+        "_first_message_cache",
+        "_tool_cache",
+        "_llm_slots",
+        "_user_locks",
+        "_http_client",
+    )
+
     def __init__(self, openai_api_key: str, default_language: str = 'en'):
         self.logger = get_logger("agent")
         self.openai_api_key = openai_api_key
         self.default_language = default_language
-        self.conversation_contexts = {}  # Store conversation context per user
-
-        # Set up LiteLLM
+        self.context_store = create_context_store(MAX_CONTEXT_MESSAGES)  # Bounded conversation context per user
+        self._llm_cache = TTLCache(maxsize=LLM_CACHE_MAX_SIZE, ttl=LLM_CACHE_TTL_SECONDS)  # cache key -> response text
+        self._inflight: Dict[str, asyncio.Task] = {}  # cache key -> completion currently running
+        self._tool_cache = TTLCache(maxsize=TOOL_CACHE_MAX_SIZE, ttl=TOOL_CACHE_TTL_SECONDS)  # search args -> formatted results
+        self._first_message_cache = FirstMessageCache(max_size=LLM_CACHE_MAX_SIZE)  # first message -> reply
+        self._llm_slots = asyncio.Semaphore(MAX_CONCURRENT_LLM_REQUESTS)
+        self._user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)  # Serializes turns per user
+
+        # Set up LiteLLM with one pooled HTTP client so TLS connections are reused across calls
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                max_connections=HTTP_MAX_CONNECTIONS
+            ),
+            timeout=httpx.Timeout(600.0, connect=10.0)
+        )
+        litellm.aclient_session = self._http_client
         litellm.set_verbose = False
         self.logger.info("AISellerAgent initialized")
-        
-        # Define function calling schema for tools format
-        self.tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_products_by_text",
-                    "description": "Search for bouquets using text query with optional filters",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query_text": {
-                                "type": "string",
-                                "description": "Text query describing what the customer is looking for"
-                            },
-                            "document_type": {
-                                "type": "string",
-                                "enum": ["text", "photo"],
-                                "description": "Type of document to search in"
-                            },
-                            "min_price": {
-                                "type": "number",
-                                "description": "Minimum price filter"
-                            },
-                            "max_price": {
-                                "type": "number", 
-                                "description": "Maximum price filter"
-                            },
-                            "k": {
-                                "type": "integer",
-                                "description": "Number of results to return (max 3)"
-                            }
-                        },
-                        "required": ["query_text"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_products_by_photo",
-                    "description": "Search for bouquets using an uploaded photo with optional filters",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "photo_path": {
-                                "type": "string",
-                                "description": "Path to the uploaded photo file"
-                            },
-                            "min_price": {
-                                "type": "number",
-                                "description": "Minimum price filter"
-                            },
-                            "max_price": {
-                                "type": "number",
-                                "description": "Maximum price filter"
-                            },
-                            "k": {
-                                "type": "integer",
-                                "description": "Number of results to return (max 3)"
-                            }
-                        },
-                        "required": ["photo_path"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "generate_payment_link",
-                    "description": "Generate a payment link for a specific product when customer wants to buy",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "price": {
-                                "type": "number",
-                                "description": "Price of the product in the smallest currency units"
-                            }
-                        },
-                        "required": ["price"]
-                    }
-                }
-            }
-        ]
-        
-        self.system_prompt = """
-You are <b>Lola</b>, an expert flower bouquet sales agent with deep knowledge of floral arrangements, occasions, and customer preferences. You speak like a real salesperson: friendly, confident, and persuasive.
-
-When a customer writes their first message (no previous conversation history):
-1) Briefly introduce yourself as Lola like this:
-'''
-Здравствуйте! Я – Лола, и здесь, чтобы помочь вам выбрать идеальный букет 💐. Предпочитаете ли вы общаться на русском языке?
-
-Сәлеметсіз бе! Мен – Лола, сізге мінсіз гүл шоғын таңдауға көмектесуге дайынмын 💐. Қазақ тілінде сөйлескенді қалайсыз ба?
-
-Salom! Men — Lola, sizga mos guldestani tanlashda yordam berishga tayyorman 💐. O‘zbek tilida suhbatlashishni istaysizmi?
-'''
-2) Ask for their name so you can address them personally.
-3) After they share their name, ask what they are looking for.
-
-FORMATTING RULES (VERY IMPORTANT):
-- ALWAYS USE ONLY TELEGRAM-SUPPORTED HTML:
-  <blockquote>quote</blockquote>
-  <b>bold</b>
-  <i>italic</i>
-  <u>underline</u>
-  <s>strike</s>
-  <a href="photo_url">photo name</a>
-  <a href="payment_url">payment button</a>
-- DO NOT USE any other markdown (no **, no #, no <br>, etc.).
-
-TONE & STYLE:
-- Proactive and helpful: ask a few smart clarifying questions to understand needs.
-- Very knowledgeable about flowers, occasions, and gift-giving.
-- Persuasive but not pushy: focus on matching needs to products, not hard-selling.
-- Natural and human, not “AI-like” or robotic.
-  - Avoid overly formal or corporate language.
-  - No long, complicated sentences.
-  - Use casual, clear language and simple phrases.
-  - Vary sentence length and rhythm so it sounds natural.
-- Keep messages short and easy to read.
-- Use emojis (💐 🎂 🎈 💌) but not too many.
-- When you know the customer’s name, use it.
-- Always reply in the customer’s language (mirror their language).
-
-NO-RESPONSE FOLLOW-UPS:
-When you get a message like: “user did not answer in X” (X = 20sec, 5 minutes, 2 hours, etc.):
-- This means the customer didn’t reply to your last message.
-- Send a short, friendly follow-up to re-engage them.
-- Use phrases like:
-  - “Did you liked any of these? 💐”
-  - “Do u want smth different?”
-  - “Waiting for your answer 🙂”
-  - “Maybe u want smth different like a more colorful bouquet or smth simple?”
-- Be context-aware: refer to what you showed or discussed before.
-- Keep it very short and conversational. Only one question per message.
-
-YOUR CAPABILITIES:
-- Search bouquets by text description or customer-uploaded photos.
-- Apply filters: price range, occasion, flower types, colors, size, style.
-- Provide personalized recommendations.
-- Explain why a bouquet fits the occasion and recipient.
-- Suggest complementary items (balloons, chocolate, cake, etc.).
-
-WHEN CUSTOMERS ASK ABOUT BOUQUETS:
-1) First quickly understand their needs:
-   - Occasion (birthday, anniversary, wedding, apology, just because, etc.)
-   - Recipient (who is it for: girlfriend, mom, friend, etc.)
-   - Basic style or color (e.g., “red”, “pastel”, “big bouquet”, “minimalistic”)
-   - Budget (if they mention it)
-2) DO NOT ask too many questions. Ask 1 short question at a time.
-   - If they struggle to describe what they want, don’t push: just show bouquets.
-3) BUDGET & DELIVERY LOGIC:
-   - By default, treat any budget the user says as the maximum price for the bouquet ONLY (product price).
-   - Do NOT subtract delivery cost by default.
-   - Show products first based on this bouquet-only budget.
-   - Only consider delivery inside the budget if the user clearly says the budget is total “with delivery” or “all in” or complains like:
-     - “I have only 500,000 with delivery”
-     - “I have only 500,000 in total”
-     - “I need bouquet + delivery max 500,000”
-   - In that case:
-     - New max bouquet price = user_total_budget - 70,000 uzs (delivery).
-     - Then search and show cheaper bouquets within that new max bouquet price.
-     - Briefly explain what you did in simple words.
-4) Search for relevant products with these signals: occasion, budget, color, style, size, recipient.
-5) If no results:
-   - First: try other bouquets in the same price range and same color.
-   - If still nothing: try same price range but different colors.
-   - Always come with some result and explain briefly why you chose it.
-   - NEVER show the same bouquet twice in a row.
-   - Do NOT ask “search again?” – just search and show.
-6) Present products in an engaging, persuasive way:
-   - Always include the bouquet photo using <a href="photo_url">photo name</a>.
-   - Mention key details:
-     - Main flowers (roses, tulips, peonies, etc.)
-     - Colors and overall style (bright, pastel, romantic, minimalistic)
-     - For which occasions it’s perfect
-     - Price in uzs
-   - Keep descriptions short, visual, and emotional.
-7) After showing products:
-   - Ask a simple follow-up:
-     - “Which one do u like more?”
-     - “Want smth more expensive / cheaper?”
-     - “Do u want it more colorful or more minimal?”
-
-WHEN CUSTOMERS UPLOAD PHOTOS:
-1) The system will search for similar bouquets automatically.
-2) Show 2–5 similar products with:
-   - Photo URL
-   - Short description
-   - Price in uzs
-   - Why it matches the photo (similar colors, similar shape, similar flowers, similar style).
-3) Explain similarities in simple language:
-   - “Same red-white style”
-   - “Very similar round shape”
-   - “Also with roses and gypsophila”
-4) Ask if they want:
-   - “Do u want same style but cheaper?”
-   - “Want smth similar but bigger / smaller?”
-   - “Or do u want smth in another color?”
-
-WHEN CUSTOMER WANTS TO BUY:
-1) First confirm which exact bouquet they want:
-   - Refer to the bouquet name or number from what you showed.
-   - Example: “So u want [Bouquet Name], right? 💐”
-2) Then collect REQUIRED information, one message at a time:
-   REQUIRED:
-   - Recipient phone number
-   - Delivery address
-   - Recipient name
-   - Delivery time
-   OPTIONAL:
-   - Card text (message on card)
-3) Flow example:
-   - Step 1: Ask which bouquet they choose.
-   - Step 2: Ask for recipient phone number.
-   - Step 3: Ask for delivery address.
-   - Step 4: Ask for recipient name.
-   - Step 5: Ask when they want it delivered (examples: “as soon as possible”, “by 8pm”, “tomorrow morning”).
-   - Step 6 (optional): Ask if they want to add a message on the card.
-   - Only one question per message.
-4) After you have:
-   - Product (with price and photo_url)
-   - Recipient phone number
-   - Delivery address
-   - Recipient name
-   - Delivery time
-   - Optional card text
-   → Create a checkout summary and generate payment link.
-
-CHECKOUT SUMMARY & PAYMENT:
-1) Delivery fee is always 70,000 uzs, separate from bouquet price (unless the user explicitly asked for total including delivery, which you already accounted for when selecting bouquet).
-2) TOTAL = product price + 70,000 uzs.
-3) Start your final checkout message with the product <a href="photo_url">photo name</a> so the picture displays.
-4) Then show a clear summary (text labels should be in the customer’s language, but structure like this):
-
-<b>📦 Checkout Summary</b>
-
-<b>Product:</b> [Product name]
-<b>Recipient phone number:</b> [phone number]
-<b>Delivery address:</b> [address or "Not provided"]
-<b>Recipient name:</b> [name]
-<b>Delivery time:</b> [delivery time]
-<b>Card text:</b> [card text or "Not provided"]
-
-<b>Product Price:</b> [price] uzs
-<b>Delivery Fee:</b> 70,000 uzs
-<b>Total:</b> [product price + 70,000] uzs
-
-5) Call tool "generate_payment_url" with the TOTAL amount in smallest currency units (e.g. 500000 for 500,000 uzs).
-6) Insert the payment link like:
-   Click the <a href="payment_url_from_generate_payment_url">payment button</a> to complete your order 💌
-7) Be calm and reassuring:
-   - “Once payment is done, we’ll start assembling right away.”
-   - “I’ll keep an eye on it and update u.”
-
-OCCASION-BASED PHRASES (you can adapt):
-- Ask lightly about occasion:
-  - “What’s the occasion? Birthday, anniversary, wedding or smth else? 🙂”
-  - “Is it a birthday, a thank-you, or just because?”
-- Delivery details:
-  - “You can drop a location pin or write the address.”
-  - “Who should receive it? Name + phone (we can coordinate quietly so it’s not spoiled).”
-  - “What time works best — a specific time or ‘any time today’?”
-- Card message:
-  - “Want to add a short card? 1–2 lines is perfect.”
-  - “Add a note? I can write it neatly on a card.”
-  - “Want a message card or keep it simple?”
-- Payment:
-  - “Here’s the payment link. I’ll start assembling as soon as it’s confirmed.”
-  - “You can pay here. Tell me once done and I’ll get it moving.”
-
-CROSS-SELL IDEAS (offer one at a time, if relevant):
-- Birthday → “Want to add small cake or balloons? 🎂🎈”
-- Anniversary / romantic → “Maybe chocolate box or a candle with it?”
-- Wedding / new home → “Maybe diffuser or a small keepsake?”
-- Teacher / thanks → “Want a big card or a few sweets?”
-
-GENERAL RULES:
-- Never ask more than one question in a single message.
-- Mirror the customer’s tone: if they are short, be shorter; if they are warm, be warm.
-- Always give practical, clear options instead of long explanations.
-- Always keep responses short, visually clear, and focused on helping them choose and buy a bouquet.
-"""
-
-    def get_conversation_context(self, user_id: int) -> List[Dict[str, str]]:
-        """Get conversation context for a user."""
-        return self.conversation_contexts.get(user_id, [])
-
-    def add_to_context(self, user_id: int, role: str, content: str, tool_calls=None, tool_call_id=None):
-        """Add a message to conversation context."""
-        if user_id not in self.conversation_contexts:
-            self.conversation_contexts[user_id] = []
-        
+
+    async def get_conversation_context(self, user_id: int) -> List[Dict[str, str]]:
+        """Get conversation context for a user, trimmed for the prompt."""
+        return self._prompt_context(await self.context_store.get(user_id))
+
+    @staticmethod
+    def _prompt_context(context: List[Dict]) -> List[Dict]:
+        """Elide old tool results and trim stored messages to the prompt token budget."""
+        # Only the latest turns need full search results; older ones are replaced to save prompt tokens
+        user_turns = [i for i, msg in enumerate(context) if msg["role"] == "user"]
+        if len(user_turns) > TOOL_RESULT_KEEP_TURNS:
+            cutoff = user_turns[-TOOL_RESULT_KEEP_TURNS]
+            context = [
+                {**msg, "content": ELIDED_TOOL_RESULT} if i < cutoff and msg["role"] == "tool" else msg
+                for i, msg in enumerate(context)
+            ]
+
+        # Drop the oldest messages until the history fits the token budget (always keep the latest one)
+        start = 0
+        total_tokens = sum(_count_tokens(msg["content"]) for msg in context)
+        while total_tokens > CONTEXT_TOKEN_BUDGET and start < len(context) - 1:
+            total_tokens -= _count_tokens(context[start]["content"])
+            start += 1
+
+        # Tool results whose assistant tool-call message was dropped are invalid prompts
+        while start < len(context) and context[start]["role"] == "tool":
+            start += 1
+        return context[start:] if start else context
+
+    async def add_to_context(self, user_id: int, role: str, content: str, tool_calls=None, tool_call_id=None) -> Dict:
+        """Add a message to conversation context and return the stored message.
+
+        Every tool result follows the assistant message that requested it. Within a turn the
+        prompt only grows, so the tool-call iterations reuse each other's cached prefix. Across
+        turns get_conversation_context elides old tool results and trims the oldest messages,
+        so only the system prompt (and tools) prefix is guaranteed to stay cached.
+        """
         message = {"role": role, "content": content}
         
-        # Add tool calls if provided
+        # Add tool calls if provided, as plain dicts so every store can serialize them
         if tool_calls:
-            message["tool_calls"] = tool_calls
+            message["tool_calls"] = [
+                tool_call.model_dump() if hasattr(tool_call, "model_dump") else tool_call
+                for tool_call in tool_calls
+            ]
         
         # Add tool call ID if provided (for tool responses)
         if tool_call_id:
             message["tool_call_id"] = tool_call_id
         
-        self.conversation_contexts[user_id].append(message)
-        
-        # # Keep only last 10 messages to manage context length
-        # if len(self.conversation_contexts[user_id]) > 10:
-        #     self.conversation_contexts[user_id] = self.conversation_contexts[user_id][-10:]
+        await self.context_store.append(user_id, message)
+        return message
 
-    def format_search_results_for_ai(self, results: List[Dict], language: str = None) -> str:
+    def format_search_results_for_ai(self, results: List[Dict]) -> str:
         """Format search results for AI processing (internal format)."""
         if not results:
             return "No bouquets found matching the criteria."
-        
-        if language is None:
-            language = self.default_language
-            
-        formatted_results = []
-        
-        for i, result in enumerate(results, 1):
-            meta = result['meta']
-            
-            name = meta.get('name_en', 'Unknown Product')
-            description = meta.get('description_en', 'No description available')
-            price = meta.get('price', 0)
-            
-            # Create structured data for AI
-            result_text = f"Product {i}: {name} | Description: {description} | Price: {price} uzs | Photo: {meta.get('photo_url')}"
 
-            formatted_results.append(result_text)
-        
-        return "\n".join(formatted_results)
+        # Create structured data for AI, one line per product
+        return "\n".join(
+            f"Product {i}: {get('name_en', 'Unknown Product')} | "
+            f"Description: {get('description_en', 'No description available')} | "
+            f"Price: {get('price', 0)} uzs | Photo: {get('photo_url')}"
+            for i, result in enumerate(results, 1)
+            for get in (result['meta'].get,)
+        )
+
+    def _choose_model(self, messages: List[Dict], message: str) -> str:
+        """Pick the model for a turn: short messages without fresh tool results go to the light model."""
+        if len(message) >= SIMPLE_MESSAGE_MAX_LENGTH:
+            return DEFAULT_MODEL
+
+        # Tool results and tool calls need the stronger model to be presented well, and so does
+        # checkout (recognized by a phone number from the customer) for the exact summary format
+        for recent in messages[-RECENT_CONTEXT_WINDOW:]:
+            if recent.get("role") == "tool" or recent.get("tool_calls"):
+                return DEFAULT_MODEL
+            if recent.get("role") == "user" and PHONE_NUMBER_PATTERN.search(recent.get("content") or ""):
+                return DEFAULT_MODEL
+        return LIGHT_MODEL
+
+    def _cache_key(self, model: str, messages: List[Dict]) -> str:
+        """Build a response cache key from the model and the full prompt."""
+        # Hash message by message instead of serializing the whole history into one string
+        digest = hashlib.sha256(model.encode())
+        for message in messages:
+            digest.update(orjson.dumps(message, option=orjson.OPT_SORT_KEYS, default=str))
+        return digest.hexdigest()
+
+    def _get_cached_response(self, cache_key: str) -> Optional[str]:
+        """Return a cached response if it exists and has not expired."""
+        return self._llm_cache.get(cache_key)
+
+    def _cache_response(self, cache_key: str, response_text: str):
+        """Store a final response in the cache (TTLCache evicts expired and least recently used entries)."""
+        if response_text:
+            self._llm_cache[cache_key] = response_text
+
+    async def _complete(self, messages: List[Dict], model: str = DEFAULT_MODEL, on_token: Optional[Callable[[str], Awaitable[None]]] = None, **kwargs):
+        """Run a chat completion and return the response message.
+
+        Transient provider errors are retried with jittered exponential backoff,
+        then the request falls back to the next model in FALLBACK_MODELS.
+        When on_token is given the completion is streamed and every content
+        delta is passed to the callback as soon as it arrives.
+        """
+        streamed = False
 
-    def _execute_tool_call(self, user_id: int, tool_call, photo_path: str = None):
-        """Execute a single tool call and add result to context."""
-        function_name = tool_call.function.name
-        function_args = json.loads(tool_call.function.arguments)
+        async def track_tokens(delta: str):
+            nonlocal streamed
+            streamed = True
+            await on_token(delta)
 
-        self.logger.debug(f"Executing tool call: {function_name} with args: {function_args}")
-
-        # Execute the function
-        if function_name == "search_products_by_text":
-            try:
-                results = search_products_by_text(
-                    query_text=function_args.get("query_text"),
-                    document_type=function_args.get("document_type"),
-                    min_price=function_args.get("min_price"),
-                    max_price=function_args.get("max_price"),
-                    k=function_args.get("k", 5)
-                )
-                search_results = self.format_search_results_for_ai(results)
-                self.logger.info(f"Text search completed for user {user_id}, found {len(results)} results")
-
-                # Add tool result to context
-                self.add_to_context(user_id, "tool", search_results, tool_call_id=tool_call.id)
-            except Exception as search_error:
-                self.logger.error(f"Error in text search for user {user_id}: {search_error}", exc_info=True)
-                error_result = f"Error: Failed to search products - {str(search_error)}"
-                self.add_to_context(user_id, "tool", error_result, tool_call_id=tool_call.id)
-
-        elif function_name == "search_products_by_photo":
-            if not photo_path:
-                self.logger.warning(f"No photo path provided for photo search for user {user_id}")
-                error_result = "Error: No photo provided for photo search"
-                self.add_to_context(user_id, "tool", error_result, tool_call_id=tool_call.id)
-            else:
+        candidates = [model] + [fallback for fallback in FALLBACK_MODELS if fallback != model]
+        for index, candidate in enumerate(candidates):
+            for attempt in range(LLM_MAX_RETRIES):
                 try:
-                    results = search_products_by_photo(
-                        photo_path=photo_path,
-                        min_price=function_args.get("min_price"),
-                        max_price=function_args.get("max_price"),
-                        k=function_args.get("k", 5)
-                    )
-                    search_results = self.format_search_results_for_ai(results)
-                    self.logger.info(f"Photo search completed for user {user_id}, found {len(results)} results")
+                    return await self._complete_once(messages, candidate, track_tokens if on_token else None, **kwargs)
+                except RETRYABLE_LLM_ERRORS as e:
+                    # A partially streamed reply can't be replayed without duplicating text
+                    if streamed:
+                        raise
+
+                    if attempt + 1 < LLM_MAX_RETRIES:
+                        delay = LLM_RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+                        self.logger.warning(f"LLM call to {candidate} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                    elif index + 1 < len(candidates):
+                        self.logger.warning(f"{candidate} unavailable after {LLM_MAX_RETRIES} attempts, falling back to {candidates[index + 1]}")
+                    else:
+                        raise
+
+    async def _complete_coalesced(self, key: str, messages: List[Dict], **kwargs):
+        """Run a completion, sharing it with concurrent callers that send an identical prompt."""
+        # A streamed completion delivers its tokens to one caller only, so it is never shared
+        if kwargs.get("on_token") is not None:
+            return await self._complete(messages, **kwargs)
+
+        # Callers only share a request sent under the same provider prompt-cache key
+        key = f"{kwargs.get('prompt_cache_key')}:{key}"
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._complete(messages, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.logger.debug("Joining in-flight LLM request for an identical prompt")
+
+        # Shield so one caller being cancelled doesn't cancel the request for the others
+        return await asyncio.shield(task)
+
+    async def _complete_once(self, messages: List[Dict], model: str, on_token: Optional[Callable[[str], Awaitable[None]]] = None, *, prompt_cache_key: str, **kwargs):
+        """Make a single (optionally streamed) chat completion request."""
+        if self._llm_slots.locked():
+            self.logger.debug(f"All {MAX_CONCURRENT_LLM_REQUESTS} LLM request slots busy, queueing request")
+
+        async with self._llm_slots:
+            if on_token is None:
+                response = await litellm.acompletion(
+                    model=model,
+                    messages=messages,
+                    api_key=self.openai_api_key,
+                    extra_body={"prompt_cache_key": prompt_cache_key},
+                    **kwargs
+                )
+                return response.choices[0].message
+
+            chunks = []
+            stream = await litellm.acompletion(
+                model=model,
+                messages=messages,
+                api_key=self.openai_api_key,
+                stream=True,
+                extra_body={"prompt_cache_key": prompt_cache_key},
+                **kwargs
+            )
+            async for chunk in stream:
+                chunks.append(chunk)
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    await on_token(delta)
+
+        # Rebuild the full response (including any streamed tool calls)
+        response = litellm.stream_chunk_builder(chunks, messages=messages)
+        return response.choices[0].message
+
+    async def _handle_text_search(self, user_id: int, function_args: Dict, photo: Optional[bytes] = None) -> str:
+        """Run search_products_by_text in a worker thread and format the results."""
+        # The model often repeats a search with the same arguments within a few turns
+        query_text = QUERY_WHITESPACE_PATTERN.sub(" ", function_args.get("query_text") or "").strip()
+        tool_cache_key = orjson.dumps({**function_args, "query_text": query_text.casefold()}, option=orjson.OPT_SORT_KEYS)
+        cached_result = self._tool_cache.get(tool_cache_key)
+        if cached_result is not None:
+            self.logger.debug(f"Reusing cached text search results for user {user_id}")
+            return cached_result
+
+        try:
+            results = await _run_search_tool(
+                "search_products_by_text",
+                query_text=query_text,
+                document_type=function_args.get("document_type"),
+                min_price=function_args.get("min_price"),
+                max_price=function_args.get("max_price"),
+                k=function_args.get("k", 5)
+            )
+            self.logger.info(f"Text search completed for user {user_id}, found {len(results)} results")
+            formatted_results = self.format_search_results_for_ai(results)
+            self._tool_cache[tool_cache_key] = formatted_results
+            return formatted_results
+        except Exception as search_error:
+            self.logger.error(f"Error in text search for user {user_id}: {search_error}", exc_info=True)
+            return f"Error: Failed to search products - {str(search_error)}"
+
+    async def _handle_photo_search(self, user_id: int, function_args: Dict, photo: Optional[bytes] = None) -> str:
+        """Run search_products_by_photo in a worker thread and format the results."""
+        if not photo:
+            self.logger.warning(f"No photo provided for photo search for user {user_id}")
+            return "Error: No photo provided for photo search"
+        try:
+            results = await _run_search_tool(
+                "search_products_by_photo",
+                photo=photo,
+                min_price=function_args.get("min_price"),
+                max_price=function_args.get("max_price"),
+                k=function_args.get("k", 5)
+            )
+            self.logger.info(f"Photo search completed for user {user_id}, found {len(results)} results")
+            return self.format_search_results_for_ai(results)
+        except Exception as search_error:
+            self.logger.error(f"Error in photo search for user {user_id}: {search_error}", exc_info=True)
+            return f"Error: Failed to search products by photo - {str(search_error)}"
+
+    async def _handle_payment(self, user_id: int, function_args: Dict, photo: Optional[bytes] = None) -> str:
+        """Generate a payment URL for the requested price."""
+        try:
+            price = function_args.get("price")
 
-                    # Add tool result to context
-                    self.add_to_context(user_id, "tool", search_results, tool_call_id=tool_call.id)
-                except Exception as search_error:
-                    self.logger.error(f"Error in photo search for user {user_id}: {search_error}", exc_info=True)
-                    error_result = f"Error: Failed to search products by photo - {str(search_error)}"
-                    self.add_to_context(user_id, "tool", error_result, tool_call_id=tool_call.id)
+            # Generate payment URL
+            payment_url = _search_tools().generate_payment_url(price)
 
-        elif function_name == "generate_payment_link":
-            try:
-                price = function_args.get("price")
+            self.logger.info(f"Payment link generated for user {user_id}: {price} uzs")
 
-                # Generate payment URL
-                payment_url = generate_payment_url(price)
+            # Format the payment result for AI
+            return f"Payment link generated (Price: {price} uzs):\n{payment_url}"
+        except Exception as payment_error:
+            self.logger.error(f"Error generating payment link for user {user_id}: {payment_error}", exc_info=True)
+            return f"Error: Failed to generate payment link - {str(payment_error)}"
 
-                # Format the payment result for AI
-                payment_result = f"Payment link generated (Price: {price} uzs):\n{payment_url}"
+    # Tool name (as declared in TOOLS) -> handler
+    _tool_handlers = {
+        "search_products_by_text": _handle_text_search,
+        "search_products_by_photo": _handle_photo_search,
+        "generate_payment_link": _handle_payment,
+    }
 
-                self.logger.info(f"Payment link generated for user {user_id}: {price} uzs")
+    async def _execute_tool_call(self, user_id: int, tool_call, photo: Optional[bytes] = None) -> str:
+        """Execute a single tool call and return its result for the context."""
+        function_name = tool_call.function.name
+        function_args = orjson.loads(tool_call.function.arguments)
+
+        self.logger.debug(f"Executing tool call: {function_name} with args: {function_args}")
 
-                # Add tool result to context
-                self.add_to_context(user_id, "tool", payment_result, tool_call_id=tool_call.id)
-            except Exception as payment_error:
-                self.logger.error(f"Error generating payment link for user {user_id}: {payment_error}", exc_info=True)
-                error_result = f"Error: Failed to generate payment link - {str(payment_error)}"
-                self.add_to_context(user_id, "tool", error_result, tool_call_id=tool_call.id)
+        handler = self._tool_handlers.get(function_name)
+        if handler is None:
+            self.logger.warning(f"Unknown tool requested for user {user_id}: {function_name}")
+            return f"Error: Unknown tool {function_name}"
+        return await handler(self, user_id, function_args, photo)
 
-    async def process_message(self, user_id: int, message: str, photo_path: str = None) -> str:
+    def _payment_reply(self, message_response) -> Optional[str]:
+        """Build the checkout reply when the only tool calls were payment links and the model already wrote the summary."""
+        # Without the model's own text (often None on tool calls) the follow-up completion writes
+        # the summary and photo link in the customer's language
+        if not message_response.content:
+            return None
+
+        tool_calls = message_response.tool_calls
+        if any(tool_call.function.name != "generate_payment_link" for tool_call in tool_calls):
+            return None
+
+        try:
+            price = orjson.loads(tool_calls[-1].function.arguments)["price"]
+            payment_url = _search_tools().generate_payment_url(price)
+            link_line = PAYMENT_REPLY_TEMPLATE.format(payment_url=payment_url, price=f"{price:,.0f}")
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+            # Let the model explain the tool error instead
+            return None
+
+        # Keep the checkout summary the model wrote alongside the tool call, minus any link it made up
+
+        def unwrap_made_up_link(match: re.Match) -> str:
+            href = match.group(1)
+            if not href.startswith("https://") or (PAYMENT_HOST in href and href != payment_url):
+                return match.group(2)
+            return match.group(0)
+
+        summary = ANCHOR_PATTERN.sub(unwrap_made_up_link, message_response.content)
+        return f"{summary}\n\n{link_line}"
+
+    async def _execute_tool_calls(self, user_id: int, tool_calls, photo: Optional[bytes] = None) -> List[Dict]:
+        """Execute tool calls concurrently, add their results to context in order and return them."""
+        results = await asyncio.gather(
+            *[self._execute_tool_call(user_id, tool_call, photo) for tool_call in tool_calls],
+            return_exceptions=True
+        )
+
+        tool_messages = []
+        for tool_call, result in zip(tool_calls, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"Tool call {tool_call.function.name} failed for user {user_id}: {result}", exc_info=result)
+                result = f"Error: Failed to execute {tool_call.function.name} - {str(result)}"
+            tool_messages.append(await self.add_to_context(user_id, "tool", result, tool_call_id=tool_call.id))
+        return tool_messages
+
+    async def process_message(self, user_id: int, message: str, photo: Optional[bytes] = None, on_token: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
         """Process a user message and return response.
 
         Supports multiple sequential tool calls - the AI can make one tool call,
         evaluate the results, and if needed, make another tool call with different
         parameters until it's satisfied with the results.
+
+        If on_token is provided, completions are streamed and text deltas are
+        passed to it as they arrive; the full response is still returned.
         """
+        user_lock = self._user_locks[user_id]
+        if user_lock.locked():
+            self.logger.debug(f"User {user_id} already has a message in progress, queueing")
+
+        # One turn per user at a time keeps their context ordered and stops a single
+        # user from occupying many of the shared LLM request slots
+        async with user_lock:
+            return await self._process_message(user_id, message, photo, on_token)
+
+    async def _process_message(self, user_id: int, message: str, photo: Optional[bytes] = None, on_token: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
+        """Run one conversation turn for a user (callers hold the user's lock)."""
         try:
             self.logger.info(f"Processing message for user {user_id}: {message[:100]}...")
+
+            # If photo is provided, start the photo search in a worker thread right away
+            # so it overlaps with context preparation and doesn't block other users
+            photo_search_task = None
+            if photo:
+                photo_search_task = asyncio.create_task(_run_search_tool(
+                    "search_products_by_photo",
+                    photo=photo,
+                    min_price=None,
+                    max_price=None,
+                    k=3
+                ))
             
             # Add user message to context
-            self.add_to_context(user_id, "user", message)
+            await self.add_to_context(user_id, "user", message)
+
+            # First messages (greetings, generic questions) can reuse the reply to the same earlier message;
+            # later turns depend on the conversation so they are never answered from this cache.
+            # "First" is judged from the raw stored context, before any eliding or trimming
+            stored_context = await self.context_store.get(user_id)
+            is_first_message = not photo and len(stored_context) == 1
+            if is_first_message:
+                cached_first_reply = self._first_message_cache.get(message)
+                if cached_first_reply is not None:
+                    await self.add_to_context(user_id, "assistant", cached_first_reply)
+                    self.logger.info(f"Served cached first-message reply for user {user_id}")
+                    return cached_first_reply
             
             # If photo is provided, automatically search by photo first
-            if photo_path:
+            if photo_search_task:
                 self.logger.info(f"Photo provided for user {user_id}, performing photo search")
                 try:
-                    # Search by photo
-                    results = search_products_by_photo(
-                        photo_path=photo_path,
-                        min_price=None,
-                        max_price=None,
-                        k=3
-                    )
+                    # Wait for the photo search started above
+                    results = await photo_search_task
                     
                     if results:
                         search_results = self.format_search_results_for_ai(results)
                         self.logger.info(f"Photo search completed for user {user_id}, found {len(results)} results")
                         
-                        # Add photo search results to context
-                        self.add_to_context(user_id, "assistant", f"Tool results:\n\n{search_results}")
-                        
-                        # Now let the AI process the results and provide a natural response
-                        messages = [{"role": "system", "content": self.system_prompt}]
-                        messages.extend(self.get_conversation_context(user_id))
-                        
-                        # Make API call with tools available for follow-up searches if needed
-                        self.logger.debug(f"Making LLM API call to process photo search results for user {user_id}")
-                        response = await litellm.acompletion(
-                            model="gpt-4o",
-                            messages=messages,
-                            tools=self.tools,
-                            tool_choice="auto",
-                            api_key=self.openai_api_key
-                        )
-                        
-                        message_response = response.choices[0].message
-
-                        # If AI wants to make additional tool calls, continue with the loop
-                        if message_response.tool_calls:
-                            # Add the assistant's message with tool calls to context
-                            self.add_to_context(user_id, "assistant", message_response.content, tool_calls=message_response.tool_calls)
-
-                            # Execute tool calls
-                            for tool_call in message_response.tool_calls:
-                                self._execute_tool_call(user_id, tool_call, photo_path)
-
-                            # Continue to the main loop below to handle sequential tool calls
-                        else:
-                            # AI is satisfied with the photo search results
-                            ai_response = message_response.content
-                            self.add_to_context(user_id, "assistant", ai_response)
-                            self.logger.info(f"AI processed photo search results for user {user_id}")
-                            return ai_response
+                        # Record the search as a regular tool call + result pair so the context keeps
+                        # the same shape as model-initiated searches; the main loop lets the AI respond
+                        photo_call_id = f"call_photo_{uuid.uuid4().hex[:24]}"
+                        await self.add_to_context(user_id, "assistant", None, tool_calls=[{
+                            "id": photo_call_id,
+                            "type": "function",
+                            "function": {"name": "search_products_by_photo", "arguments": '{"k": 3}'}
+                        }])
+                        await self.add_to_context(user_id, "tool", search_results, tool_call_id=photo_call_id)
                     else:
                         self.logger.warning(f"No results found for photo search for user {user_id}")
                         # Continue with normal text processing
@@ -492,95 +663,164 @@ GENERAL RULES:
             # Main loop: Continue until AI doesn't request more tool calls or max iterations reached
             max_iterations = 5  # Prevent infinite loops
             iteration = 0
+
+            # Replies built from fresh search results (or a photo) are not cached
+            used_tools = photo is not None
+
+            # Prepare messages for LLM once; each iteration only appends the new tool-call turn
+            # (the photo search added its tool call to the store, so only then is the context fetched again)
+            if photo_search_task:
+                stored_context = await self.context_store.get(user_id)
+            messages = [SYSTEM_MESSAGE, *self._prompt_context(stored_context)]
             
             while iteration < max_iterations:
                 iteration += 1
                 self.logger.debug(f"Tool call iteration {iteration} for user {user_id}")
-                
-                # Prepare messages for LLM
-                messages = [{"role": "system", "content": self.system_prompt}]
-                messages.extend(self.get_conversation_context(user_id))
+
+                # Serve identical prompts from the response cache
+                model = self._choose_model(messages, message)
+                cache_key = self._cache_key(model, messages)
+                cached_response = self._get_cached_response(cache_key)
+                if cached_response is not None:
+                    await self.add_to_context(user_id, "assistant", cached_response)
+                    self.logger.info(f"Served cached response for user {user_id} (iteration {iteration})")
+                    return cached_response
                 
                 # Make API call with tools
-                self.logger.debug(f"Making LLM API call for user {user_id} (iteration {iteration})")
-                response = await litellm.acompletion(
-                    model="gpt-4o",
-                    messages=messages,
+                self.logger.debug(f"Making LLM API call with {model} for user {user_id} (iteration {iteration})")
+                message_response = await self._complete_coalesced(
+                    cache_key,
+                    messages,
+                    model=model,
+                    on_token=on_token,
+                    prompt_cache_key=PROMPT_CACHE_KEY,
                     tools=self.tools,
                     tool_choice="auto",
-                    api_key=self.openai_api_key
+                    parallel_tool_calls=True
                 )
 
-                message_response = response.choices[0].message
-
                 # Check if AI wants to make tool calls
                 if message_response.tool_calls:
                     self.logger.info(f"LLM requested tool calls for user {user_id} (iteration {iteration}): {[tc.function.name for tc in message_response.tool_calls]}")
                     
                     # Add the assistant's message with tool calls to context
-                    self.add_to_context(user_id, "assistant", message_response.content, tool_calls=message_response.tool_calls)
+                    messages.append(await self.add_to_context(user_id, "assistant", message_response.content, tool_calls=message_response.tool_calls))
+                    used_tools = True
                     
-                    # Execute each tool call
-                    for tool_call in message_response.tool_calls:
-                        self._execute_tool_call(user_id, tool_call, photo_path)
+                    # Execute all tool calls concurrently
+                    messages.extend(await self._execute_tool_calls(user_id, message_response.tool_calls, photo))
+
+                    # Checkout turns that already have the model's summary only need the link appended,
+                    # so answer without another LLM call
+                    payment_reply = self._payment_reply(message_response)
+                    if payment_reply:
+                        await self.add_to_context(user_id, "assistant", payment_reply)
+                        self.logger.info(f"Sent templated payment reply for user {user_id} (iteration {iteration})")
+                        return payment_reply
                     
                     # Continue the loop to let AI evaluate results and potentially make another tool call
                     continue
                 
                 # No more tool calls - AI is ready to respond
                 response_text = message_response.content
-                self.add_to_context(user_id, "assistant", response_text)
+                await self.add_to_context(user_id, "assistant", response_text)
+                if not used_tools:
+                    self._cache_response(cache_key, response_text)
+                    if is_first_message and response_text:
+                        self._first_message_cache.put(message, response_text)
                 self.logger.info(f"Final response generated for user {user_id} after {iteration} iteration(s)")
                 return response_text
 
-            # Max iterations reached - return the last response even if it has tool calls
-            if message_response.tool_calls:
-                self.logger.warning(f"Max iterations ({max_iterations}) reached for user {user_id}, returning last response")
-                # Still execute the tool calls and return a message
-                self.add_to_context(user_id, "assistant", message_response.content or "I've reached the maximum number of search attempts. Let me provide you with the best results I found.", tool_calls=message_response.tool_calls)
-                for tool_call in message_response.tool_calls:
-                    self._execute_tool_call(user_id, tool_call, photo_path)
-                
-                # Get final response
-                messages = [{"role": "system", "content": self.system_prompt}]
-                messages.extend(self.get_conversation_context(user_id))
-                final_response_obj = await litellm.acompletion(
-                    model="gpt-4o",
-                    messages=messages,
-                    api_key=self.openai_api_key
-                )
-                final_text = final_response_obj.choices[0].message.content
-                self.add_to_context(user_id, "assistant", final_text)
-                return final_text
-            else:
-                response_text = message_response.content
-                self.add_to_context(user_id, "assistant", response_text)
-                return response_text
+            # Max iterations reached - the last tool calls already ran inside the loop, so reply
+            # with what the AI said alongside them instead of paying for another LLM call
+            self.logger.warning(f"Max iterations ({max_iterations}) reached for user {user_id}, returning last response")
+            final_text = message_response.content or MAX_ITERATIONS_REPLIES[self._reply_language(message)]
+            await self.add_to_context(user_id, "assistant", final_text)
+            return final_text
             
         except Exception as e:
             self.logger.error(f"Error processing message for user {user_id}: {e}", exc_info=True)
             error_msg = "I apologize, but I encountered an error while processing your request. Please try again."
-            self.add_to_context(user_id, "assistant", error_msg)
+            await self.add_to_context(user_id, "assistant", error_msg)
             return error_msg
 
-    def clear_context(self, user_id: int):
+    def _reply_language(self, message: str) -> str:
+        """Guess the customer's language from their message's script, for replies the model didn't write."""
+        if KAZAKH_LETTERS_PATTERN.search(message):
+            return "kk"
+        if CYRILLIC_PATTERN.search(message):
+            return "ru"
+        if UZBEK_LATIN_PATTERN.search(message):
+            return "uz"
+        return self.default_language if self.default_language in MAX_ITERATIONS_REPLIES else "en"
+
+    async def warm_up(self):
+        """Warm the provider's prompt cache, the tokenizer and the search models concurrently, before real traffic."""
+        await asyncio.gather(self._warm_up_prompt_cache(), self._warm_up_tokenizer(), self._warm_up_search())
+
+    async def _warm_up_prompt_cache(self):
+        """Send the shared system prompt + tools prefix once, under the key real turns use, so the provider caches it."""
+        try:
+            await self._complete_once(
+                [SYSTEM_MESSAGE, {"role": "user", "content": "Hi"}],
+                DEFAULT_MODEL,
+                prompt_cache_key=PROMPT_CACHE_KEY,
+                tools=self.tools,
+                max_tokens=1
+            )
+            self.logger.info("Prompt cache warm-up request completed")
+        except Exception as e:
+            self.logger.warning(f"Prompt cache warm-up failed: {e}")
+
+    async def _warm_up_tokenizer(self):
+        """Load the tokenizer off the event loop; if it can't be loaded, token counts stay estimates."""
+        try:
+            await asyncio.to_thread(_load_tokenizer)
+            self.logger.info("Tokenizer loaded")
+        except Exception as e:
+            self.logger.warning(f"Failed to load the tokenizer, estimating token counts from text length: {e}")
+
+    async def _warm_up_search(self):
+        """Load search_tools (models and index) in a worker thread and run its warm-up encodes."""
+        try:
+            await _run_search_tool("warm_up")
+        except Exception as e:
+            self.logger.warning(f"Search warm-up failed: {e}")
+
+    async def aclose(self):
+        """Close the pooled HTTP client used for LLM calls."""
+        await self._http_client.aclose()
+        self.logger.info("AISellerAgent HTTP client closed")
+
+    async def clear_context(self, user_id: int):
         """Clear conversation context for a user."""
-        if user_id in self.conversation_contexts:
-            del self.conversation_contexts[user_id]
+        await self.context_store.clear(user_id)
 
     async def transcribe_voice(self, audio_path: str) -> str:
         """Transcribe voice message to text using OpenAI Whisper via LiteLLM."""
         try:
             self.logger.debug(f"Starting transcription for file: {audio_path}")
 
-            # Use LiteLLM to transcribe with OpenAI Whisper (consistent with other AI operations)
-            with open(audio_path, 'rb') as audio_file:
-                # LiteLLM transcription API
-                response = await litellm.atranscription(
-                    model="gpt-4o-mini-transcribe",
-                    file=audio_file,
-                    api_key=self.openai_api_key
-                )
+            # Read the voice note without blocking the event loop
+            async with aiofiles.open(audio_path, 'rb') as audio_file:
+                audio_bytes = await audio_file.read()
+
+            # Use LiteLLM to transcribe (consistent with other AI operations), falling back to
+            # whisper-1 if the primary transcription model is rate limited
+            for model in TRANSCRIPTION_MODELS:
+                upload = io.BytesIO(audio_bytes)
+                upload.name = os.path.basename(audio_path)  # The API infers the audio format from the name
+                try:
+                    response = await litellm.atranscription(
+                        model=model,
+                        file=upload,
+                        api_key=self.openai_api_key
+                    )
+                    break
+                except litellm.exceptions.RateLimitError:
+                    if model == TRANSCRIPTION_MODELS[-1]:
+                        raise
+                    self.logger.warning(f"Transcription model {model} rate limited, falling back")
 
             # LiteLLM returns a dict with 'text' key
             transcribed_text = response.get('text', '').strip()
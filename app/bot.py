@@ -1,19 +1,171 @@
 import asyncio
+import html
 import os
 import tempfile
 import re
 import time
+from cachetools import LRUCache, TTLCache
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional, Dict, Set
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message, InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 from .agent import AISellerAgent
+from .followup_store import FollowupStore
 from .logger_config import get_logger
 
 # Load environment variables
 load_dotenv()
 
+# Minimum seconds between edits of a streamed response preview (Telegram rate-limits edits)
+STREAM_EDIT_INTERVAL = 1.5
+
+# Telegram shows a typing indicator for about 5 seconds, so long operations refresh it
+TYPING_REFRESH_INTERVAL = 4
+
+# File extensions for audio MIME types, so transcription can tell the format
+AUDIO_MIME_EXTENSIONS = {
+    "audio/mpeg": ".mp3",
+    "audio/mp3": ".mp3",
+    "audio/ogg": ".ogg",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/wave": ".wav",
+}
+
+# Telegram message length limit
+MAX_MESSAGE_LENGTH = 4096
+
+# Tags Telegram accepts with parse_mode="HTML"; anything else makes the send fail.
+# One pass matches a tag, an entity or a lone <, > or &; it has no nested quantifiers, so it scans in linear time.
+TELEGRAM_ALLOWED_TAGS = frozenset({
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del",
+    "a", "code", "pre", "blockquote", "tg-spoiler", "span"
+})
+HTML_MARKUP_PATTERN = re.compile(r'</?([a-zA-Z][a-zA-Z0-9-]*)\b[^<>]*>|&(?:[a-zA-Z]+|#[0-9]+|#x[0-9a-fA-F]+);|[<>&]')
+
+# Patterns used on every outgoing response, compiled once.
+# The lookahead rejects URLs that continue past /public, so a match is always a complete delivery URL
+IMAGEDELIVERY_URL_PATTERN = re.compile(r'https://imagedelivery\.net/[a-zA-Z0-9\-]+/[a-zA-Z0-9\-]+/public(?![a-zA-Z0-9\-/])')
+TILDACDN_URL_PATTERN = re.compile(r'https://static\.tildacdn\.com/[a-zA-Z0-9\-/]+\.(?:jpg|jpeg|png|gif|webp)', re.IGNORECASE)
+# Click payment URLs - precise pattern to avoid HTML artifacts
+PAYMENT_URL_PATTERN = re.compile(r'https://my\.click\.uz/services/pay/\?service_id=\d+&merchant_id=\d+&amount=[\d.]+&transaction_param=[a-f0-9\-]+&return_url=https://t\.me/[a-zA-Z0-9_]+')
+ANY_HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+SPACES_PATTERN = re.compile(r'[ \t]+')
+BLANK_LINES_PATTERN = re.compile(r'\n\s*\n')
+
+# Minimum seconds before the first response to a new user, to simulate a human typing
+FIRST_MESSAGE_DELAY_SECONDS = 15
+
+# Fixed replies, built once instead of per command
+WELCOME_FALLBACK_TEXT = "Welcome! I'm here to help you find the perfect bouquet. How can I assist you today?"
+HELP_TEXT = """🆘 How to use our AI Flower Shop:
+
+<b>Text Search:</b>
+Just describe what you're looking for! For example:
+• "I need a romantic bouquet for my girlfriend"
+• "Show me white roses under $50"
+• "I want something for a birthday party"
+
+<b>Photo Search:</b>
+Upload a photo of a bouquet you like, and I'll find similar ones in our collection.
+
+<b>Voice Messages:</b>
+Send me a voice message describing what you're looking for, and I'll understand and help you find the perfect bouquet! 🎤
+
+<b>Price Filters:</b>
+I can help you find bouquets within your budget. Just mention your price range!
+
+<b>Occasions:</b>
+I know about all kinds of occasions - birthdays, anniversaries, apologies, congratulations, and more!
+
+Need more help? Just ask! 😊"""
+
+# Users idle for this long are forgotten; the sweep runs every USER_SWEEP_INTERVAL_SECONDS
+USER_IDLE_EXPIRY_SECONDS = 86400
+USER_SWEEP_INTERVAL_SECONDS = 300
+
+# Follow-up messages for inactive users: (type, seconds after the bot's last response)
+FOLLOWUP_SCHEDULE = [("first", 300), ("second", 10800)]
+# One bit per follow-up type, used to record which follow-ups were sent
+FOLLOWUP_BITS = {followup_type: 1 << i for i, (followup_type, _) in enumerate(FOLLOWUP_SCHEDULE)}
+FOLLOWUP_DELAYS = dict(FOLLOWUP_SCHEDULE)
+# Follow-ups that came due more than this long ago (e.g. while the bot was down) are dropped
+FOLLOWUP_MAX_LATENESS_SECONDS = 3600
+# Pause before the follow-up driver retries after a schedule read fails
+FOLLOWUP_DRIVER_RETRY_SECONDS = 5
+
+# Telegram keeps a get_file download path valid for at least an hour; reuse it for a bit less
+FILE_PATH_CACHE_TTL_SECONDS = 3300
+FILE_PATH_CACHE_MAX_SIZE = 1024
+
+# Number of texts remembered as having HTML that Telegram rejects
+BAD_HTML_CACHE_SIZE = 256
+
+
+@dataclass(slots=True)
+class UserState:
+    """Per-user activity and follow-up tracking, kept in one record per user."""
+    last_message_time: float = 0.0  # When the user last sent a message
+    last_bot_response_time: float = 0.0  # When the bot last responded
+    first_message_sent: bool = False  # First message gets the human-like delay
+    first_message_time: float = 0.0  # When the first message arrived, start of that delay
+    sent_followups: int = 0  # Bitmask of FOLLOWUP_BITS
+
+
+@lru_cache(maxsize=256)
+def payment_keyboard(payment_url: str) -> InlineKeyboardMarkup:
+    """Return the payment button keyboard for a URL, reusing it for repeated links."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💳 Pay Now", url=payment_url)]
+    ])
+
+
+class ResponseDraft:
+    """Live preview of a streamed AI response, edited in place as tokens arrive."""
+
+    def __init__(self, telegram_bot: "TelegramBot", message: Message):
+        self.telegram_bot = telegram_bot
+        self.message = message
+        self.text = ""
+        self.draft_message: Optional[Message] = None
+        self.last_edit_time = 0.0
+
+    async def on_token(self, delta: str):
+        """Accumulate a text delta and refresh the preview if enough time has passed."""
+        self.text += delta
+        if time.monotonic() - self.last_edit_time < STREAM_EDIT_INTERVAL:
+            return
+
+        # Partial HTML may be unbalanced, so the preview is sent as plain text
+        preview = self.telegram_bot.strip_html_formatting(self.text)[:MAX_MESSAGE_LENGTH]
+        if not preview:
+            return
+
+        self.last_edit_time = time.monotonic()
+        try:
+            if self.draft_message is None:
+                self.draft_message = await self.message.answer(preview)
+            elif preview != self.draft_message.text:
+                self.draft_message = await self.draft_message.edit_text(preview)
+        except Exception as e:
+            self.telegram_bot.logger.debug(f"Failed to update response preview for user {self.message.from_user.id}: {e}")
+
+    async def discard(self):
+        """Delete the preview before the final formatted response is sent."""
+        if self.draft_message is None:
+            return
+        try:
+            await self.draft_message.delete()
+        except Exception as e:
+            self.telegram_bot.logger.debug(f"Failed to delete response preview for user {self.message.from_user.id}: {e}")
+        self.draft_message = None
+
+
 class TelegramBot:
     def __init__(self):
         self.logger = get_logger("bot")
@@ -21,20 +173,22 @@ class TelegramBot:
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         self.default_language = os.getenv("DEFAULT_LANGUAGE", "en")
         
-        # Track users who have sent their first message
-        self.first_message_sent = set()
+        # Activity and follow-up state per user
+        self.users: Dict[int, UserState] = {}
 
-        # Track last message time per user (when user sent message)
-        self.last_message_time: Dict[int, float] = {}
+        # Scheduled follow-ups (persisted) and the signal that wakes the follow-up driver when they change
+        self.followup_store = FollowupStore()
+        self.followups_changed = asyncio.Event()
+        self.followup_tasks: Set[asyncio.Task] = set()
 
-        # Track last bot response time per user (when bot sent message)
-        self.last_bot_response_time: Dict[int, float] = {}
+        # Serializes message handling per user
+        self.user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
 
-        # Track pending follow-up tasks per user
-        self.pending_followups: Dict[int, Dict[str, asyncio.Task]] = {}
+        # Hashes of texts Telegram rejected as HTML, sent as plain text from then on
+        self.bad_html_responses: LRUCache = LRUCache(maxsize=BAD_HTML_CACHE_SIZE)
 
-        # Track which follow-ups have been sent per user
-        self.sent_followups: Dict[int, Set[str]] = {}
+        # Download paths from get_file, keyed by file_id
+        self.file_path_cache: TTLCache = TTLCache(maxsize=FILE_PATH_CACHE_MAX_SIZE, ttl=FILE_PATH_CACHE_TTL_SECONDS)
 
         if not self.bot_token or not self.openai_api_key:
             self.logger.error("Missing required environment variables: TELEGRAM_BOT_TOKEN and OPENAI_API_KEY")
@@ -57,6 +211,18 @@ class TelegramBot:
     
     def register_handlers(self):
         """Register all bot handlers."""
+
+        @self.dp.message.outer_middleware()
+        async def serialize_user_messages(handler, message: Message, data):
+            """Handle one message per user at a time so a burst can't spawn parallel downloads and AI calls."""
+            if message.from_user is None:
+                return await handler(message, data)
+
+            user_lock = self.user_locks[message.from_user.id]
+            if user_lock.locked():
+                self.logger.debug(f"User {message.from_user.id} has a message in progress, queueing")
+            async with user_lock:
+                return await handler(message, data)
         
         @self.dp.message(Command("start"))
         async def start_handler(message: Message):
@@ -66,8 +232,7 @@ class TelegramBot:
                 self.logger.info(f"User {user_id} started the bot")
 
                 # Reset first message tracking
-                if user_id in self.first_message_sent:
-                    self.first_message_sent.remove(user_id)
+                self._user(user_id).first_message_sent = False
 
                 # Create a special instruction message for the AI to greet the user
                 # This simulates a user message that instructs the AI to greet in multiple languages
@@ -83,8 +248,8 @@ class TelegramBot:
                 # Send the AI response
                 await self.send_response_with_photos(message, response)
 
-                # Mark that this user has sent their first message (so subsequent messages won't have the 15s delay)
-                self.first_message_sent.add(user_id)
+                # Mark that this user has sent their first message (so subsequent messages won't have the first-message delay)
+                self._user(user_id).first_message_sent = True
 
                 # Update bot response time
                 self.update_bot_response_time(user_id)
@@ -93,39 +258,14 @@ class TelegramBot:
             except Exception as e:
                 self.logger.error(f"Error in start handler: {e}", exc_info=True)
                 # Fallback to a simple welcome message if AI processing fails
-                try:
-                    await message.answer("Welcome! I'm here to help you find the perfect bouquet. How can I assist you today?", parse_mode="HTML")
-                except Exception:
-                    await message.answer("Welcome! I'm here to help you find the perfect bouquet. How can I assist you today?")
+                await message.answer(WELCOME_FALLBACK_TEXT)
         
         @self.dp.message(Command("help"))
         async def help_handler(message: Message):
             """Handle /help command."""
             try:
                 self.logger.info(f"User {message.from_user.id} requested help")
-                help_text = """🆘 How to use our AI Flower Shop:
-
-<b>Text Search:</b>
-Just describe what you're looking for! For example:
-• "I need a romantic bouquet for my girlfriend"
-• "Show me white roses under $50"
-• "I want something for a birthday party"
-
-<b>Photo Search:</b>
-Upload a photo of a bouquet you like, and I'll find similar ones in our collection.
-
-<b>Voice Messages:</b>
-Send me a voice message describing what you're looking for, and I'll understand and help you find the perfect bouquet! 🎤
-
-<b>Price Filters:</b>
-I can help you find bouquets within your budget. Just mention your price range!
-
-<b>Occasions:</b>
-I know about all kinds of occasions - birthdays, anniversaries, apologies, congratulations, and more!
-
-Need more help? Just ask! 😊"""
-                
-                await message.answer(help_text, parse_mode="HTML")
+                await message.answer(HELP_TEXT, parse_mode="HTML")
                 self.logger.info(f"Help message sent to user {message.from_user.id}")
             except Exception as e:
                 self.logger.error(f"Error in help handler: {e}", exc_info=True)
@@ -137,7 +277,7 @@ Need more help? Just ask! 😊"""
             try:
                 user_id = message.from_user.id
                 self.logger.info(f"User {user_id} cleared conversation context")
-                self.agent.clear_context(user_id)
+                await self.agent.clear_context(user_id)
                 await message.answer("🔄 Our conversation has been reset. How can I help you find the perfect bouquet?")
                 self.logger.info(f"Context cleared for user {user_id}")
             except Exception as e:
@@ -148,40 +288,26 @@ Need more help? Just ask! 😊"""
         async def photo_handler(message: Message):
             """Handle photo messages."""
             user_id = message.from_user.id
-            temp_path = None
             try:
                 self.logger.info(f"User {user_id} uploaded a photo")
                 
-                # Check if this is the first message from this user
-                is_first_message = user_id not in self.first_message_sent
-
-                if is_first_message:
-                    # Mark that this user has sent their first message
-                    self.first_message_sent.add(user_id)
-                    self.logger.info(f"First message from user {user_id}, waiting 15 seconds before responding...")
-
-                    # Wait 15 seconds to simulate human-like response time
-                    await asyncio.sleep(15)
-                    self.logger.info(f"15 second delay completed for user {user_id}, processing with AI...")
+                # Start the human-like delay clock if this is the user's first message
+                self._start_first_message_delay(user_id)
 
                 # Update last message time and cancel pending follow-ups
-                self.update_user_activity(user_id)
+                await self.update_user_activity(user_id)
 
                 # Get the highest resolution photo
                 photo = message.photo[-1]
                 self.logger.debug(f"Photo file_id: {photo.file_id}, size: {photo.file_size}")
                 
-                # Download photo
-                file_info = await self.bot.get_file(photo.file_id)
-                file_path = file_info.file_path
-                
-                # Create temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                    temp_path = temp_file.name
-                
-                # Download photo to temporary file
-                await self.bot.download_file(file_path, temp_path)
-                self.logger.debug(f"Photo downloaded to: {temp_path}")
+                # Download photo into memory; the search reads the bytes directly
+                file_path = await self._resolve_file(photo.file_id)
+                photo_bytes = (await self.bot.download_file(file_path)).getvalue()
+                self.logger.debug(f"Photo downloaded: {len(photo_bytes)} bytes")
+
+                # Wait out the rest of the first-message delay (the download counts towards it)
+                await self._wait_first_message_delay(user_id)
                 
                 # Process with AI agent
                 user_message = message.caption or "I uploaded a photo, please find similar bouquets"
@@ -190,38 +316,28 @@ Need more help? Just ask! 😊"""
                 # Send typing indicator
                 await self.bot.send_chat_action(user_id, "typing")
                 
-                response = await self.agent.process_message(user_id, user_message, temp_path)
+                draft = ResponseDraft(self, message)
+                response = await self.agent.process_message(user_id, user_message, photo_bytes, on_token=draft.on_token)
                 self.logger.info(f"AI response generated for user {user_id}")
                 
                 # Check if response contains photo URLs and send them
+                await draft.discard()
                 await self.send_response_with_photos(message, response)
 
                 # Update bot response time and schedule follow-up messages
                 self.update_bot_response_time(user_id)
-                self.schedule_followups(user_id)
+                await self.schedule_followups(user_id)
                 
             except Exception as e:
                 self.logger.error(f"Error processing photo from user {user_id}: {e}", exc_info=True)
-                # Try HTML first, then plain text for error message
-                try:
-                    await message.answer("I apologize, but I had trouble processing your photo. Please try uploading it again or describe what you're looking for in text.", parse_mode="HTML")
-                except Exception as html_error:
-                    self.logger.warning(f"HTML formatting failed for error message: {html_error}")
-                    await message.answer("I apologize, but I had trouble processing your photo. Please try uploading it again or describe what you're looking for in text.")
-            finally:
-                # Clean up temporary file
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.unlink(temp_path)
-                        self.logger.debug(f"Cleaned up temporary file: {temp_path}")
-                    except Exception as cleanup_error:
-                        self.logger.warning(f"Failed to clean up temporary file {temp_path}: {cleanup_error}")
+                await message.answer("I apologize, but I had trouble processing your photo. Please try uploading it again or describe what you're looking for in text.")
         
         @self.dp.message(F.voice | F.video_note)
         async def voice_handler(message: Message):
             """Handle voice messages and video notes."""
             user_id = message.from_user.id
             temp_path = None
+            typing_task = None
             try:
                 # Determine if it's a voice message or video note
                 if message.voice:
@@ -233,41 +349,24 @@ Need more help? Just ask! 😊"""
                 else:
                     return
 
-                # Check if this is the first message from this user
-                is_first_message = user_id not in self.first_message_sent
-
-                if is_first_message:
-                    # Mark that this user has sent their first message
-                    self.first_message_sent.add(user_id)
-                    self.logger.info(f"First message from user {user_id}, waiting 15 seconds before responding...")
-
-                    # Wait 15 seconds to simulate human-like response time
-                    await asyncio.sleep(15)
-                    self.logger.info(f"15 second delay completed for user {user_id}, processing with AI...")
+                # Start the human-like delay clock if this is the user's first message
+                self._start_first_message_delay(user_id)
 
                 # Update last message time and cancel pending follow-ups
-                self.update_user_activity(user_id)
+                await self.update_user_activity(user_id)
 
-                # Send typing indicator
-                await self.bot.send_chat_action(user_id, "typing")
-
-                # Download voice file
-                file_info = await self.bot.get_file(audio_file.file_id)
-                file_path = file_info.file_path
+                # Keep the typing indicator up through download, transcription and the AI call
+                typing_task = asyncio.create_task(self._keep_typing(user_id))
 
-                # Determine file extension based on MIME type or default to ogg
-                file_extension = '.ogg'  # Default for Telegram voice messages
-                if hasattr(audio_file, 'mime_type') and audio_file.mime_type:
-                    if 'mpeg' in audio_file.mime_type or 'mp3' in audio_file.mime_type:
-                        file_extension = '.mp3'
-                    elif 'ogg' in audio_file.mime_type:
-                        file_extension = '.ogg'
-                    elif 'wav' in audio_file.mime_type:
-                        file_extension = '.wav'
+                # Determine file extension based on MIME type or default to ogg (Telegram voice messages)
+                file_extension = AUDIO_MIME_EXTENSIONS.get(getattr(audio_file, 'mime_type', None), '.ogg')
 
-                # Create temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-                    temp_path = temp_file.name
+                # Create the temporary file while the download path is being resolved
+                temp_file_task = asyncio.create_task(self._create_temp_file(file_extension))
+                try:
+                    file_path = await self._resolve_file(audio_file.file_id)
+                finally:
+                    temp_path = await temp_file_task
 
                 # Download voice file to temporary file
                 await self.bot.download_file(file_path, temp_path)
@@ -284,33 +383,32 @@ Need more help? Just ask! 😊"""
 
                 self.logger.info(f"Voice transcribed for user {user_id}: {transcribed_text[:100]}...")
 
+                # Wait out the rest of the first-message delay (download and transcription count towards it)
+                await self._wait_first_message_delay(user_id)
+
                 # Process transcribed text with AI agent
-                response = await self.agent.process_message(user_id, transcribed_text)
+                draft = ResponseDraft(self, message)
+                response = await self.agent.process_message(user_id, transcribed_text, on_token=draft.on_token)
                 self.logger.info(f"AI response generated for user {user_id}")
+                typing_task.cancel()
 
                 # Check if response contains photo URLs and send them
+                await draft.discard()
                 await self.send_response_with_photos(message, response)
 
                 # Update bot response time and schedule follow-up messages
                 self.update_bot_response_time(user_id)
-                self.schedule_followups(user_id)
+                await self.schedule_followups(user_id)
 
             except Exception as e:
                 self.logger.error(f"Error processing voice message from user {user_id}: {e}", exc_info=True)
-                # Try HTML first, then plain text for error message
-                try:
-                    await message.answer("I apologize, but I had trouble processing your voice message. Please try sending it again or use text instead.", parse_mode="HTML")
-                except Exception as html_error:
-                    self.logger.warning(f"HTML formatting failed for error message: {html_error}")
-                    await message.answer("I apologize, but I had trouble processing your voice message. Please try sending it again or use text instead.")
+                await message.answer("I apologize, but I had trouble processing your voice message. Please try sending it again or use text instead.")
             finally:
+                if typing_task:
+                    typing_task.cancel()
                 # Clean up temporary file
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.unlink(temp_path)
-                        self.logger.debug(f"Cleaned up temporary file: {temp_path}")
-                    except Exception as cleanup_error:
-                        self.logger.warning(f"Failed to clean up temporary file {temp_path}: {cleanup_error}")
+                if temp_path:
+                    await self._remove_temp_file(temp_path)
 
         @self.dp.message(F.location)
         async def location_handler(message: Message):
@@ -330,20 +428,12 @@ Need more help? Just ask! 😊"""
 
                 self.logger.info(f"User {user_id} sent location: {latitude}, {longitude}")
 
-                # Check if this is the first message from this user
-                is_first_message = user_id not in self.first_message_sent
-
-                if is_first_message:
-                    # Mark that this user has sent their first message
-                    self.first_message_sent.add(user_id)
-                    self.logger.info(f"First message from user {user_id}, waiting 15 seconds before responding...")
-
-                    # Wait 15 seconds to simulate human-like response time
-                    await asyncio.sleep(15)
-                    self.logger.info(f"15 second delay completed for user {user_id}, processing with AI...")
+                # Start the human-like delay clock if this is the user's first message
+                self._start_first_message_delay(user_id)
+                await self._wait_first_message_delay(user_id)
 
                 # Update last message time and cancel pending follow-ups
-                self.update_user_activity(user_id)
+                await self.update_user_activity(user_id)
 
                 # Send typing indicator
                 await self.bot.send_chat_action(user_id, "typing")
@@ -357,16 +447,11 @@ Need more help? Just ask! 😊"""
 
                 # Update bot response time and schedule follow-up messages
                 self.update_bot_response_time(user_id)
-                self.schedule_followups(user_id)
+                await self.schedule_followups(user_id)
 
             except Exception as e:
                 self.logger.error(f"Error processing location from user {user_id}: {e}", exc_info=True)
-                # Try HTML first, then plain text for error message
-                try:
-                    await message.answer("I apologize, but I had trouble processing your location. Please try sending it again or describe your location in text.", parse_mode="HTML")
-                except Exception as html_error:
-                    self.logger.warning(f"HTML formatting failed for error message: {html_error}")
-                    await message.answer("I apologize, but I had trouble processing your location. Please try sending it again or describe your location in text.")
+                await message.answer("I apologize, but I had trouble processing your location. Please try sending it again or describe your location in text.")
 
         @self.dp.message()
         async def text_handler(message: Message):
@@ -376,139 +461,126 @@ Need more help? Just ask! 😊"""
                 user_message = message.text
                 self.logger.info(f"User {user_id} sent text message: {user_message[:100]}...")
                 
-                # Check if this is the first message from this user
-                is_first_message = user_id not in self.first_message_sent
-
-                if is_first_message:
-                    # Mark that this user has sent their first message
-                    self.first_message_sent.add(user_id)
-                    self.logger.info(f"First message from user {user_id}, waiting 15 seconds before responding...")
-
-                    # Wait 15 seconds to simulate human-like response time
-                    await asyncio.sleep(15)
-                    self.logger.info(f"15 second delay completed for user {user_id}, processing with AI...")
+                # Start the human-like delay clock if this is the user's first message
+                self._start_first_message_delay(user_id)
+                await self._wait_first_message_delay(user_id)
 
                 # Update last message time and cancel pending follow-ups
-                self.update_user_activity(user_id)
+                await self.update_user_activity(user_id)
 
                 # Send typing indicator
                 await self.bot.send_chat_action(user_id, "typing")
                 
-                # Process with AI agent
-                response = await self.agent.process_message(user_id, user_message)
+                # Process with AI agent, streaming a live preview of the response
+                draft = ResponseDraft(self, message)
+                response = await self.agent.process_message(user_id, user_message, on_token=draft.on_token)
                 self.logger.info(f"AI response generated for user {user_id}")
                 
                 # Check if response contains photo URLs and send them
+                await draft.discard()
                 await self.send_response_with_photos(message, response)
 
                 # Update bot response time and schedule follow-up messages
                 self.update_bot_response_time(user_id)
-                self.schedule_followups(user_id)
+                await self.schedule_followups(user_id)
                 
             except Exception as e:
                 self.logger.error(f"Error processing text message from user {user_id}: {e}", exc_info=True)
-                # Try HTML first, then plain text for error message
-                try:
-                    await message.answer("I apologize, but I encountered an error. Please try again or use /help for assistance.", parse_mode="HTML")
-                except Exception as html_error:
-                    self.logger.warning(f"HTML formatting failed for error message: {html_error}")
-                    await message.answer("I apologize, but I encountered an error. Please try again or use /help for assistance.")
+                await message.answer("I apologize, but I encountered an error. Please try again or use /help for assistance.")
     
+    def sanitize_telegram_html(self, text: str) -> str:
+        """Drop HTML tags Telegram doesn't support (turning <br> into a newline) and escape stray <, > and &."""
+        def replace_markup(match: re.Match) -> str:
+            markup = match.group(0)
+            tag = match.group(1)
+            if tag is None:
+                # Entities are kept; a lone <, > or & would make Telegram reject the whole message
+                return markup if len(markup) > 1 else html.escape(markup)
+            tag = tag.lower()
+            if tag in TELEGRAM_ALLOWED_TAGS:
+                return markup
+            return "\n" if tag == "br" else ""
+
+        return HTML_MARKUP_PATTERN.sub(replace_markup, text)
+
+    async def _resolve_file(self, file_id: str) -> str:
+        """Return the download path for a Telegram file, skipping get_file when it was resolved recently."""
+        file_path = self.file_path_cache.get(file_id)
+        if file_path is not None:
+            self.logger.debug(f"Reusing cached file path for {file_id}")
+            return file_path
+
+        file_info = await self.bot.get_file(file_id)
+        self.file_path_cache[file_id] = file_info.file_path
+        return file_info.file_path
+
+    async def _keep_typing(self, user_id: int):
+        """Show the typing indicator until cancelled, refreshing it before Telegram clears it."""
+        while True:
+            try:
+                await self.bot.send_chat_action(user_id, "typing")
+            except Exception as e:
+                self.logger.debug(f"Failed to send typing indicator to user {user_id}: {e}")
+            await asyncio.sleep(TYPING_REFRESH_INTERVAL)
+
+    async def _create_temp_file(self, suffix: str) -> str:
+        """Create an empty temporary file in a worker thread and return its path."""
+        def create() -> str:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+                return temp_file.name
+
+        return await asyncio.to_thread(create)
+
+    async def _remove_temp_file(self, temp_path: str):
+        """Delete a temporary file in a worker thread."""
+        try:
+            await asyncio.to_thread(os.unlink, temp_path)
+            self.logger.debug(f"Cleaned up temporary file: {temp_path}")
+        except FileNotFoundError:
+            pass
+        except Exception as cleanup_error:
+            self.logger.warning(f"Failed to clean up temporary file {temp_path}: {cleanup_error}")
+
     def strip_html_formatting(self, text: str) -> str:
         """Strip HTML formatting and return plain text."""
-        import re
-        
         # Remove HTML tags
-        text = re.sub(r'<[^>]+>', '', text)
-        
-        # Decode common HTML entities
-        html_entities = {
-            '&lt;': '<',
-            '&gt;': '>',
-            '&amp;': '&',
-            '&quot;': '"',
-            '&#39;': "'",
-            '&nbsp;': ' '
-        }
+        text = ANY_HTML_TAG_PATTERN.sub('', text)
         
-        for entity, char in html_entities.items():
-            text = text.replace(entity, char)
+        # Decode HTML entities (named and numeric) in a single pass; &nbsp; becomes a plain space
+        text = html.unescape(text).replace('\xa0', ' ')
         
         # Clean up extra whitespace but preserve intentional spaces
-        text = re.sub(r'[ \t]+', ' ', text)  # Replace multiple spaces/tabs with single space
-        text = re.sub(r'\n\s*\n', '\n', text)  # Replace multiple newlines with single newline
+        text = SPACES_PATTERN.sub(' ', text)  # Replace multiple spaces/tabs with single space
+        text = BLANK_LINES_PATTERN.sub('\n', text)  # Replace multiple newlines with single newline
         text = text.strip()
         
         return text
 
     def create_payment_keyboard(self, payment_url: str) -> InlineKeyboardMarkup:
         """Create inline keyboard with payment button."""
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Pay Now", url=payment_url)]
-        ])
-        return keyboard
+        return payment_keyboard(payment_url)
 
     def extract_payment_url(self, text: str) -> Optional[str]:
         """Extract payment URL from text if present."""
-        # Look for Click payment URLs - more precise pattern to avoid HTML artifacts
-        payment_pattern = r'https://my\.click\.uz/services/pay/\?service_id=\d+&merchant_id=\d+&amount=[\d.]+&transaction_param=[a-f0-9\-]+&return_url=https://t\.me/[a-zA-Z0-9_]+'
-        match = re.search(payment_pattern, text)
+        match = PAYMENT_URL_PATTERN.search(text)
         return match.group(0) if match else None
 
     async def send_response_with_photos(self, message: Message, response: str):
         """Send response with photos if URLs are found."""
         user_id = message.from_user.id
+
+        # URLs are taken from the raw response: sanitizing escapes their bare '&' separators
+        # Check for payment URL first; every send path below reuses the keyboard
+        payment_url = self.extract_payment_url(response)
+        keyboard = self.create_payment_keyboard(payment_url) if payment_url else None
+        # Extract photo URLs from response - supports both imagedelivery.net and static.tildacdn.com formats.
+        # The patterns match complete URLs, so the matches need no further cleanup
+        photo_urls = IMAGEDELIVERY_URL_PATTERN.findall(response) + TILDACDN_URL_PATTERN.findall(response)
+
+        # Only the text that is sent gets sanitized, so the HTML send doesn't fail and fall back to plain text
+        response = self.sanitize_telegram_html(response)
         try:
-            # Check for payment URL first
-            payment_url = self.extract_payment_url(response)
-            keyboard = self.create_payment_keyboard(payment_url) if payment_url else None
-            
-            # Extract photo URLs from response - supports both imagedelivery.net and static.tildacdn.com formats
-            # Pattern 1: imagedelivery.net URLs
-            imagedelivery_urls = re.findall(r'https://imagedelivery\.net/[a-zA-Z0-9\-]+/[a-zA-Z0-9\-]+/public', response)
-            # Pattern 2: static.tildacdn.com URLs (using non-capturing group to avoid tuple results)
-            tildacdn_urls = re.findall(r'https://static\.tildacdn\.com/[a-zA-Z0-9\-/]+\.(?:jpg|jpeg|png|gif|webp)', response, re.IGNORECASE)
-
-            photo_urls = imagedelivery_urls + tildacdn_urls
-            self.logger.debug(f"Found {len(photo_urls)} photo URLs for user {user_id}")
-            
-            # Clean up any URLs that might have extra characters
-            cleaned_urls = []
-            for url in photo_urls:
-                # First, try to extract just the URL part using regex patterns
-                url_match = None
-                # Try imagedelivery.net pattern
-                url_match = re.search(r'(https://imagedelivery\.net/[a-zA-Z0-9\-]+/[a-zA-Z0-9\-]+/public)', url)
-                if not url_match:
-                    # Try static.tildacdn.com pattern
-                    url_match = re.search(r'(https://static\.tildacdn\.com/[a-zA-Z0-9\-/]+\.(jpg|jpeg|png|gif|webp))', url, re.IGNORECASE)
-
-                if url_match:
-                    clean_url = url_match.group(1)
-                else:
-                    # Fallback: remove trailing characters that aren't part of the URL
-                    clean_url = re.sub(r'[^a-zA-Z0-9\-/\.:]+$', '', url)
-                    # Additional cleanup for common HTML artifacts
-                    clean_url = clean_url.replace('">', '').replace('>', '').replace('"', '')
-                
-                # Validate the URL format - support both formats
-                is_valid = False
-                if clean_url.startswith('https://imagedelivery.net/'):
-                    # imagedelivery.net format: should end with /public and have 6 parts
-                    if clean_url.endswith('/public') and len(clean_url.split('/')) == 6:
-                        is_valid = True
-                elif clean_url.startswith('https://static.tildacdn.com/'):
-                    # static.tildacdn.com format: should be a valid image URL
-                    if re.match(r'https://static\.tildacdn\.com/[a-zA-Z0-9\-/]+\.(jpg|jpeg|png|gif|webp)$', clean_url, re.IGNORECASE):
-                        is_valid = True
-
-                if is_valid:
-                    cleaned_urls.append(clean_url)
-                else:
-                    self.logger.warning(f"Invalid photo URL format: {url} -> {clean_url}")
-            
-            photo_urls = cleaned_urls
-            self.logger.debug(f"Cleaned photo URLs: {photo_urls}")
+            self.logger.debug(f"Found {len(photo_urls)} photo URLs for user {user_id}: {photo_urls}")
             
             if photo_urls:
                 try:
@@ -524,18 +596,12 @@ Need more help? Just ask! 😊"""
                     else:
                         # Multiple photos in media group
                         self.logger.info(f"Sending media group with {len(photo_urls)} photos to user {user_id}")
-                        media_group = []
-                        for i, photo_url in enumerate(photo_urls[:10]):  # Limit to 10 photos
-                            if i == 0:
-                                # First photo gets the caption
-                                media_group.append(InputMediaPhoto(
-                                    media=photo_url,
-                                    caption=response,
-                                    parse_mode="HTML"
-                                ))
-                            else:
-                                # Other photos without caption
-                                media_group.append(InputMediaPhoto(media=photo_url))
+                        group_urls = photo_urls[:10]  # Limit to 10 photos
+                        # First photo gets the caption, the others go without
+                        media_group = [
+                            InputMediaPhoto(media=group_urls[0], caption=response, parse_mode="HTML"),
+                            *(InputMediaPhoto(media=photo_url) for photo_url in group_urls[1:]),
+                        ]
                         
                         await message.answer_media_group(media=media_group)
                         
@@ -551,105 +617,158 @@ Need more help? Just ask! 😊"""
                 except Exception as photo_error:
                     self.logger.warning(f"Failed to send photos to user {user_id}: {photo_error}")
                     # If photos fail, try HTML formatting first, then plain text
-                    try:
-                        await message.answer(response, parse_mode="HTML", reply_markup=keyboard)
-                    except Exception as html_error:
-                        self.logger.warning(f"HTML formatting failed, sending plain text: {html_error}")
-                        # If HTML fails, send plain text
-                        plain_text = self.strip_html_formatting(response)
-                        await message.answer(plain_text, reply_markup=keyboard)
+                    await self._safe_answer(message, response, reply_markup=keyboard)
             else:
                 # No photos found, try HTML formatting first, then plain text
                 self.logger.debug(f"No photos found, sending text only to user {user_id}")
-                try:
-                    await message.answer(response, parse_mode="HTML", reply_markup=keyboard)
-                except Exception as html_error:
-                    self.logger.warning(f"HTML formatting failed, sending plain text: {html_error}")
-                    # If HTML fails, send plain text
-                    plain_text = self.strip_html_formatting(response)
-                    await message.answer(plain_text, reply_markup=keyboard)
+                await self._safe_answer(message, response, reply_markup=keyboard)
                 
         except Exception as e:
             self.logger.error(f"Error in send_response_with_photos for user {user_id}: {e}", exc_info=True)
             # Last resort: try HTML first, then plain text
+            await self._safe_answer(message, response, reply_markup=keyboard)
+
+    async def _safe_answer(self, message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        """Reply with HTML formatting, falling back to plain text when Telegram rejects the markup."""
+        text_hash = hash(text)
+        if text_hash not in self.bad_html_responses:
             try:
-                payment_url = self.extract_payment_url(response)
-                keyboard = self.create_payment_keyboard(payment_url) if payment_url else None
-                await message.answer(response, parse_mode="HTML", reply_markup=keyboard)
+                await message.answer(text, parse_mode="HTML", reply_markup=reply_markup)
+                return
+            except TelegramBadRequest as html_error:
+                # Identical text would fail again, so repeats go straight to plain text
+                self.bad_html_responses[text_hash] = True
+                self.logger.warning(f"HTML formatting rejected, sending plain text: {html_error}")
             except Exception as html_error:
-                self.logger.warning(f"HTML formatting failed in fallback, sending plain text: {html_error}")
-                # If HTML fails, send plain text
-                plain_text = self.strip_html_formatting(response)
-                payment_url = self.extract_payment_url(plain_text)
-                keyboard = self.create_payment_keyboard(payment_url) if payment_url else None
-                await message.answer(plain_text, reply_markup=keyboard)
-
-    def update_user_activity(self, user_id: int):
+                self.logger.warning(f"HTML formatting failed, sending plain text: {html_error}")
+
+        await message.answer(self.strip_html_formatting(text), reply_markup=reply_markup)
+
+    def _user(self, user_id: int) -> UserState:
+        """Return the tracked state for a user, creating it on first contact."""
+        user_state = self.users.get(user_id)
+        if user_state is None:
+            user_state = self.users[user_id] = UserState()
+        return user_state
+
+    def _start_first_message_delay(self, user_id: int):
+        """Start the human-like response delay if this is the user's first message."""
+        user_state = self._user(user_id)
+        if user_state.first_message_sent:
+            return
+
+        user_state.first_message_sent = True
+        user_state.first_message_time = time.monotonic()
+        self.logger.info(f"First message from user {user_id}, responding after {FIRST_MESSAGE_DELAY_SECONDS} seconds...")
+
+    async def _wait_first_message_delay(self, user_id: int):
+        """Sleep for whatever is left of the first-message delay; work done since it started counts towards it."""
+        remaining = self._user(user_id).first_message_time + FIRST_MESSAGE_DELAY_SECONDS - time.monotonic()
+        if remaining <= 0:
+            return
+
+        await asyncio.sleep(remaining)
+        self.logger.info(f"First-message delay completed for user {user_id}, processing with AI...")
+
+    async def _sweep_idle_users(self):
+        """Periodically drop the state of users who have been idle for a day, so it doesn't grow forever."""
+        while True:
+            await asyncio.sleep(USER_SWEEP_INTERVAL_SECONDS)
+            cutoff = time.monotonic() - USER_IDLE_EXPIRY_SECONDS
+            # Users whose message is still being handled are kept, even if their timestamps are old
+            idle_user_ids = [
+                user_id for user_id, user_state in self.users.items()
+                if max(user_state.last_message_time, user_state.last_bot_response_time, user_state.first_message_time) < cutoff
+                and not (user_id in self.user_locks and self.user_locks[user_id].locked())
+            ]
+            for user_id in idle_user_ids:
+                del self.users[user_id]
+                self.user_locks.pop(user_id, None)
+            if idle_user_ids:
+                self.logger.info(f"Expired state for {len(idle_user_ids)} idle users")
+
+    async def update_user_activity(self, user_id: int):
         """Update last message time and cancel pending follow-ups."""
-        self.last_message_time[user_id] = time.time()
+        user_state = self._user(user_id)
+        user_state.last_message_time = time.monotonic()
 
-        # Cancel any pending follow-up tasks
-        if user_id in self.pending_followups:
-            for followup_type, task in self.pending_followups[user_id].items():
-                if not task.done():
-                    task.cancel()
-                    self.logger.debug(f"Cancelled pending {followup_type} follow-up for user {user_id}")
-            self.pending_followups[user_id] = {}
+        # Cancel the pending follow-up schedule; it restarts after the bot's next response
+        await self.followup_store.cancel(user_id)
+        self.followups_changed.set()
 
         # Reset sent follow-ups when user is active
-        if user_id in self.sent_followups:
-            self.sent_followups[user_id] = set()
+        user_state.sent_followups = 0
 
     def update_bot_response_time(self, user_id: int):
         """Update last bot response time when bot sends a message."""
-        self.last_bot_response_time[user_id] = time.time()
+        self._user(user_id).last_bot_response_time = time.monotonic()
 
-    def schedule_followups(self, user_id: int):
+    async def schedule_followups(self, user_id: int):
         """Schedule follow-up messages for inactive users."""
-        # Initialize pending followups dict for user if needed
-        if user_id not in self.pending_followups:
-            self.pending_followups[user_id] = {}
-
-        # Initialize sent followups set for user if needed
-        if user_id not in self.sent_followups:
-            self.sent_followups[user_id] = set()
+        # Due times are wall-clock because they are persisted across restarts
+        now = time.time()
+        await self.followup_store.schedule(
+            user_id,
+            {followup_type: now + delay_seconds for followup_type, delay_seconds in FOLLOWUP_SCHEDULE}
+        )
+        self.followups_changed.set()
+
+    async def _followup_driver(self):
+        """Send follow-ups as they come due; a single task serves every user."""
+        while True:
+            self.followups_changed.clear()
+            try:
+                next_followup = await self.followup_store.next_due()
+            except Exception as e:
+                self.logger.error(f"Failed to read the follow-up schedule: {e}", exc_info=True)
+                await asyncio.sleep(FOLLOWUP_DRIVER_RETRY_SECONDS)
+                continue
 
-        # Schedule first follow-up: 5 minutes (300 seconds)
-        if "first" not in self.pending_followups[user_id] or self.pending_followups[user_id]["first"].done():
-            task1 = asyncio.create_task(self.send_followup(user_id, "first", 300))
-            self.pending_followups[user_id]["first"] = task1
+            # Sleep until the earliest follow-up is due, or until the schedule changes
+            remaining = None if next_followup is None else next_followup[2] - time.time()
+            if remaining is None or remaining > 0:
+                try:
+                    await asyncio.wait_for(self.followups_changed.wait(), remaining)
+                except TimeoutError:
+                    pass
+                continue
 
-        # Schedule second follow-up: 3 hours (10800 seconds)
-        if "second" not in self.pending_followups[user_id] or self.pending_followups[user_id]["second"].done():
-            task2 = asyncio.create_task(self.send_followup(user_id, "second", 10800))
-            self.pending_followups[user_id]["second"] = task2
+            user_id, followup_type, _ = next_followup
+            try:
+                await self.followup_store.remove(user_id, followup_type)
+            except Exception as e:
+                # Retry later instead of sending a follow-up that is still in the schedule
+                self.logger.error(f"Failed to remove {followup_type} follow-up for user {user_id}: {e}", exc_info=True)
+                await asyncio.sleep(FOLLOWUP_DRIVER_RETRY_SECONDS)
+                continue
+            if -remaining > FOLLOWUP_MAX_LATENESS_SECONDS:
+                # Came due while the bot was down; too late to be a natural follow-up
+                self.logger.info(f"Dropping overdue {followup_type} follow-up for user {user_id}")
+                continue
+
+            # Generating the follow-up takes an AI call, so it runs alongside the driver
+            send_task = asyncio.create_task(self.send_followup(user_id, followup_type, FOLLOWUP_DELAYS[followup_type]))
+            self.followup_tasks.add(send_task)
+            send_task.add_done_callback(self.followup_tasks.discard)
 
     async def send_followup(self, user_id: int, followup_type: str, delay_seconds: float):
-        """Send a follow-up message after delay if user hasn't responded."""
+        """Send a follow-up message if user hasn't responded."""
         try:
-            # Wait for the delay
-            await asyncio.sleep(delay_seconds)
+            user_state = self._user(user_id)
 
-            # Check if user has sent a message since the bot's last response
-            if user_id in self.last_bot_response_time:
-                bot_response_time = self.last_bot_response_time[user_id]
-
-                # If user responded after bot's last message, don't send follow-up
-                if user_id in self.last_message_time:
-                    user_message_time = self.last_message_time[user_id]
-                    if user_message_time > bot_response_time:
-                        self.logger.info(f"Skipping {followup_type} follow-up for user {user_id} - user responded after bot's message")
-                        return
+            # If user responded after bot's last message, don't send follow-up
+            if user_state.last_message_time > user_state.last_bot_response_time:
+                self.logger.info(f"Skipping {followup_type} follow-up for user {user_id} - user responded after bot's message")
+                return
 
             # Check if this follow-up was already sent
-            if user_id in self.sent_followups and followup_type in self.sent_followups[user_id]:
+            followup_bit = FOLLOWUP_BITS[followup_type]
+            if user_state.sent_followups & followup_bit:
                 self.logger.debug(f"{followup_type} follow-up already sent for user {user_id}")
                 return
 
             # Mark this follow-up as sent
-            if user_id not in self.sent_followups:
-                self.sent_followups[user_id] = set()
-            self.sent_followups[user_id].add(followup_type)
+            user_state.sent_followups |= followup_bit
 
             self.logger.info(f"Sending {followup_type} follow-up to user {user_id} after {delay_seconds} seconds")
 
@@ -678,10 +797,8 @@ Need more help? Just ask! 😊"""
                 fallback = fallback_messages.get(followup_type, "How can I help you find the perfect bouquet? 💐")
                 await self.bot.send_message(user_id, fallback, parse_mode="HTML")
                 # Add fallback to context
-                self.agent.add_to_context(user_id, "assistant", fallback)
+                await self.agent.add_to_context(user_id, "assistant", fallback)
 
-        except asyncio.CancelledError:
-            self.logger.debug(f"Follow-up {followup_type} for user {user_id} was cancelled")
         except Exception as e:
             self.logger.error(f"Error sending {followup_type} follow-up to user {user_id}: {e}", exc_info=True)
 
@@ -703,6 +820,12 @@ Need more help? Just ask! 😊"""
         print("🤖 AI Seller Bot is starting...")
         print("🌸 Ready to help customers find perfect bouquets!")
         
+        # Warm the provider's prompt cache, the tokenizer and search models in the background while polling starts
+        warm_up_task = asyncio.create_task(self.agent.warm_up())
+        # Background upkeep: idle-user expiry and the follow-up schedule
+        sweeper_task = asyncio.create_task(self._sweep_idle_users())
+        followup_driver_task = asyncio.create_task(self._followup_driver())
+
         try:
             self.logger.info("Starting bot polling...")
             await self.dp.start_polling(self.bot)
@@ -711,9 +834,16 @@ Need more help? Just ask! 😊"""
             print(f"Error starting bot: {e}")
         finally:
             self.logger.info("Stopping bot...")
+            warm_up_task.cancel()
+            sweeper_task.cancel()
+            followup_driver_task.cancel()
             await self.bot.session.close()
+            await self.agent.aclose()
+            self.followup_store.close()
     
     async def stop(self):
         """Stop the bot gracefully."""
         self.logger.info("Stopping bot gracefully...")
         await self.bot.session.close()
+        await self.agent.aclose()
+        self.followup_store.close()
@@ -0,0 +1,65 @@
+import numpy as np
+from typing import Dict, List, Optional
+from .logger_config import get_logger
+
+
+def top_per_bouquet(scores, metadatas: List[Dict], k: int) -> List[Dict]:
+    """Rank query hits best first and keep each bouquet's best hit, as up to k {'score', 'meta'} dicts."""
+    scores = np.asarray(scores)
+    order = np.argsort(-scores, kind='stable')
+    bouquet_ids = np.asarray([str(meta['bouquet_id']) for meta in metadatas])
+    _, first_positions = np.unique(bouquet_ids[order], return_index=True)
+    return [{'score': float(scores[i]), 'meta': metadatas[i]} for i in order[np.sort(first_positions)[:k]]]
+
+
+class BouquetIndex:
+    """In-memory copy of the bouquet collection, searched by exact cosine similarity."""
+
+    def __init__(self, collection):
+        self.logger = get_logger("bouquet_index")
+        data = collection.get(include=["embeddings", "metadatas"])
+        self.metadatas: List[Dict] = data["metadatas"] or []
+
+        embeddings = np.asarray(data["embeddings"] if self.metadatas else np.empty((0, 0)), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True) if len(embeddings) else 1.0
+        self.embeddings = embeddings / np.where(norms == 0, 1.0, norms)
+
+        # Filter columns, so filtering is a vectorized mask instead of a metadata scan
+        self.types = np.array([meta.get("type") for meta in self.metadatas])
+        self.prices = np.array([meta.get("price", 0) for meta in self.metadatas], dtype=np.float64)
+        # Dense integer code per bouquet_id, used to keep one document per bouquet
+        self.bouquet_codes = np.unique([str(meta['bouquet_id']) for meta in self.metadatas], return_inverse=True)[1]
+        # Most documents any bouquet has (text + photo), so the top k * this many documents cover k bouquets
+        self.max_documents_per_bouquet = int(np.bincount(self.bouquet_codes).max()) if self.metadatas else 1
+        self.logger.info(f"Loaded {len(self.metadatas)} bouquet documents into memory")
+
+    def search(self, query_embedding, document_type: Optional[str] = None, min_price=None, max_price=None, k: int = 5) -> List[Dict]:
+        """Return the top k bouquets as {'score', 'meta'} dicts, keeping each bouquet's best-scoring document."""
+        if not self.metadatas:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = self.embeddings @ (query / (np.linalg.norm(query) or 1.0))
+
+        mask = np.ones(len(scores), dtype=bool)
+        if document_type:
+            mask &= self.types == document_type
+        if min_price:
+            mask &= self.prices >= min_price
+        if max_price:
+            mask &= self.prices <= max_price
+        candidates = np.flatnonzero(mask)
+
+        # Only the best k * max_documents_per_bouquet candidates can hold the top k bouquets,
+        # so partition those out in linear time and sort just them
+        candidate_scores = scores[candidates]
+        limit = k * self.max_documents_per_bouquet
+        if limit < len(candidates):
+            top = np.argpartition(-candidate_scores, limit - 1)[:limit]
+            candidates, candidate_scores = candidates[top], candidate_scores[top]
+
+        # Rank candidates best first, then keep the first (best) document of each bouquet
+        ranked = candidates[np.argsort(-candidate_scores, kind='stable')]
+        _, first_positions = np.unique(self.bouquet_codes[ranked], return_index=True)
+        top_documents = ranked[np.sort(first_positions)[:k]]
+        return [{'score': float(scores[i]), 'meta': self.metadatas[i]} for i in top_documents]
@@ -0,0 +1,28 @@
+import os
+
+# Chroma server to connect to; without CHROMA_HOST the local ./chroma_db is opened in-process
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+CHROMA_PATH = "./chroma_db"
+
+# Name of the Chroma collection holding bouquet text and photo embeddings
+BOUQUET_COLLECTION = "bouquets"
+
+# Index settings for the bouquet collection. Scores are computed as 1 - distance, which
+# assumes cosine distance. Chroma fixes these when the collection is created, so an existing
+# ./chroma_db has to be deleted and rebuilt with `python -m app.embed` to pick them up
+BOUQUET_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+
+
+def create_client():
+    """Return a client for the shared Chroma server when CHROMA_HOST is set, otherwise for the local database."""
+    import chromadb  # Heavy import, only paid by code that actually opens the database
+
+    if CHROMA_HOST:
+        return chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    return chromadb.PersistentClient(path=CHROMA_PATH)
@@ -0,0 +1,90 @@
+import orjson
+import os
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Dict, List
+from .logger_config import get_logger
+
+# Conversations stored in Redis expire after a day of inactivity
+CONTEXT_TTL_SECONDS = 86400
+
+
+class ContextStore(ABC):
+    """Interface for per-user conversation context storage."""
+
+    @abstractmethod
+    async def get(self, user_id: int) -> List[Dict]:
+        """Return the stored messages for a user, oldest first."""
+
+    @abstractmethod
+    async def append(self, user_id: int, message: Dict):
+        """Append a message to a user's context."""
+
+    @abstractmethod
+    async def clear(self, user_id: int):
+        """Delete a user's context."""
+
+
+class InMemoryContextStore(ContextStore):
+    """Keeps conversation context in process memory (lost on restart)."""
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self.contexts: Dict[int, deque] = {}
+
+    async def get(self, user_id: int) -> List[Dict]:
+        return list(self.contexts.get(user_id, ()))
+
+    async def append(self, user_id: int, message: Dict):
+        if user_id not in self.contexts:
+            # Oldest messages are evicted automatically once the limit is reached
+            self.contexts[user_id] = deque(maxlen=self.max_messages)
+        self.contexts[user_id].append(message)
+
+    async def clear(self, user_id: int):
+        self.contexts.pop(user_id, None)
+
+
+class RedisContextStore(ContextStore):
+    """Keeps conversation context in Redis lists, shared between workers and kept across restarts."""
+
+    def __init__(self, redis_url: str, max_messages: int, ttl_seconds: int = CONTEXT_TTL_SECONDS):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise ImportError("REDIS_URL is set but the 'redis' package is not installed (pip install -e '.[redis]')") from e
+
+        self.redis = redis.Redis.from_url(redis_url)
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, user_id: int) -> str:
+        return f"convo:{user_id}"
+
+    async def get(self, user_id: int) -> List[Dict]:
+        raw_messages = await self.redis.lrange(self._key(user_id), 0, -1)
+        return [orjson.loads(raw) for raw in raw_messages]
+
+    async def append(self, user_id: int, message: Dict):
+        key = self._key(user_id)
+        # Append, keep only the newest messages and refresh the TTL in one round-trip
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, orjson.dumps(message))
+            pipe.ltrim(key, -self.max_messages, -1)
+            pipe.expire(key, self.ttl_seconds)
+            await pipe.execute()
+
+    async def clear(self, user_id: int):
+        await self.redis.delete(self._key(user_id))
+
+
+def create_context_store(max_messages: int) -> ContextStore:
+    """Create a Redis-backed store when REDIS_URL is set, otherwise an in-memory one."""
+    logger = get_logger("context_store")
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        logger.info("Using Redis conversation context store")
+        return RedisContextStore(redis_url, max_messages)
+
+    logger.info("Using in-memory conversation context store")
+    return InMemoryContextStore(max_messages)
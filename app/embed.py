@@ -1,18 +1,51 @@
 from sentence_transformers import SentenceTransformer
-import chromadb
-import json  # Assuming your DB is a JSON list of bouquets
-from PIL import Image
+from app.chroma_config import BOUQUET_COLLECTION, BOUQUET_COLLECTION_METADATA, create_client
+import orjson  # Assuming your DB is a JSON list of bouquets
 import requests
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from requests.adapters import HTTPAdapter
+from app.embedding_cache import EmbeddingCache
+from app.image_utils import open_for_clip
 
-# Load separate models
-text_model = SentenceTransformer('sentence-transformers/clip-ViT-B-32-multilingual-v1')  # For text (multilingual)
-image_model = SentenceTransformer('clip-ViT-B-32')  # For images (base CLIP vision)
-client = chromadb.PersistentClient(path="./chroma_db")
-collection = client.get_or_create_collection(name="bouquets")
+TEXT_MODEL_NAME = 'sentence-transformers/clip-ViT-B-32-multilingual-v1'
 
-# Load your bouquet DB (e.g., from file or API)
-bouquets = json.load(open('data/bouquets.json'))  # List of dicts like your sample
+# Encoder batch sizes and the number of documents written to Chroma per upsert
+TEXT_BATCH_SIZE = 64
+IMAGE_BATCH_SIZE = 32
+UPSERT_BATCH_SIZE = 1000
+
+# Photos are downloaded in parallel over a pooled session
+DOWNLOAD_WORKERS = 32
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS))
+
+# Models, Chroma and the embedding cache are built on first use, so importing this module is cheap
+@cache
+def get_text_model():
+    return half_on_gpu(SentenceTransformer(TEXT_MODEL_NAME))  # For text (multilingual)
+
+@cache
+def get_image_model():
+    return half_on_gpu(SentenceTransformer('clip-ViT-B-32'))  # For images (base CLIP vision)
+
+def half_on_gpu(model):
+    """SentenceTransformer already picks a GPU when one is available; there, run ingestion in half precision."""
+    return model.half() if model.device.type == 'cuda' else model
+
+@cache
+def text_model_id():
+    """Cache key part identifying the text encoder and its precision, matching search_tools' ':fp16' suffix."""
+    return f"{TEXT_MODEL_NAME}:fp16" if get_text_model().device.type == 'cuda' else TEXT_MODEL_NAME
+
+@cache
+def get_collection():
+    client = create_client()
+    return client.get_or_create_collection(name=BOUQUET_COLLECTION, metadata=BOUQUET_COLLECTION_METADATA)
+
+@cache
+def get_embedding_cache():
+    return EmbeddingCache()  # Unchanged bouquet texts skip the encoder on re-ingest
 
 def normalize_photo_url(photo_url_or_uuid):
     """
@@ -35,14 +68,14 @@ def normalize_photo_url(photo_url_or_uuid):
     # Otherwise, assume it's a UUID and construct the imagedelivery.net URL
     return f"https://imagedelivery.net/kjxkUqyuhQCleQqPHYxkVQ/{photo_url_or_uuid}/public"
 
-def embed_text(bouquet):
+def text_payload(bouquet):
+    """Build the (doc_id, text, metadata) entry for a bouquet's text embedding."""
     tags_en = [tag['en'] for tag in bouquet['tags']]
     text = (
         f"Bouquet Name: {bouquet['name']['en']}. "
         f"Description: {bouquet['description']['en']}. "
         f"Tags: {', '.join(tags_en)}. "
     )
-    embedding = text_model.encode(text).tolist()
     doc_id = f"text_{bouquet['id']}"
 
     photo_url = normalize_photo_url(bouquet['photo_urls'][0]) if bouquet.get('photo_urls') else None
@@ -57,23 +90,26 @@ def embed_text(bouquet):
         "price": bouquet['price'],
         "photo_url": photo_url,
     }
-    collection.upsert(  # Use upsert for updates
-        ids=[doc_id],
-        embeddings=[embedding],
-        # documents=[text],
-        metadatas=[metadata]
-    )
+    return doc_id, text, metadata
 
 
-def embed_photo(bouquet):
+def photo_payload(bouquet):
+    """Download a bouquet's first photo and build its (doc_id, image, metadata) entry, or None without a usable photo."""
     if not bouquet['photo_urls']:
-        return
+        return None
     photo_url_or_uuid = bouquet['photo_urls'][0]
     img_url = normalize_photo_url(photo_url_or_uuid)
 
-    response = requests.get(img_url, timeout=30)
-    image = Image.open(BytesIO(response.content)).convert('RGB')
-    embedding = image_model.encode(image).tolist()  # CLIP image encoder
+    # A failed download or undecodable photo skips this bouquet instead of aborting the whole run
+    try:
+        response = http_session.get(img_url, timeout=30)
+        response.raise_for_status()
+        # Shrink to CLIP's input scale here, in the download workers, so full-size photos
+        # aren't all held in memory until encoding
+        image = open_for_clip(response.content)
+    except Exception as e:
+        print(f"Skipping photo of bouquet {bouquet['id']} ({img_url}): {e}")
+        return None
     doc_id = f"photo_{bouquet['id']}"
 
     metadata = {
@@ -86,17 +122,57 @@ def embed_photo(bouquet):
         "price": bouquet['price'],
         "photo_url": img_url,
     }
-    collection.upsert(
-        ids=[doc_id],
-        embeddings=[embedding],
-        # documents=[f"Photo of {bouquet['name']['en']} bouquet"],
-        metadatas=[metadata]
-    )
+    return doc_id, image, metadata
+
+
+def batch_encoder(model, batch_size):
+    """Return a function that encodes a list of inputs in one batched pass."""
+    def encode(contents):
+        return model.encode(contents, batch_size=batch_size, show_progress_bar=True, convert_to_numpy=True)
+    return encode
+
+
+def cached_text_encoder(encode):
+    """Wrap a text encoder so only texts missing from the embedding cache are encoded."""
+    def encode_cached(texts):
+        return get_embedding_cache().get_or_compute_many(texts, text_model_id(), encode)
+    return encode_cached
+
+
+def embed_and_upsert(encode, entries):
+    """Encode all entries in one batched pass and upsert them, in chunks Chroma accepts."""
+    if not entries:
+        return
+    embeddings = encode([content for _, content, _ in entries])
+    for start in range(0, len(entries), UPSERT_BATCH_SIZE):
+        chunk = entries[start:start + UPSERT_BATCH_SIZE]
+        get_collection().upsert(  # Use upsert for updates
+            ids=[doc_id for doc_id, _, _ in chunk],
+            embeddings=embeddings[start:start + UPSERT_BATCH_SIZE],
+            metadatas=[metadata for _, _, metadata in chunk]
+        )
+
+
+def main():
+    """Embed every active bouquet's text and first photo into the Chroma collection."""
+    # Load your bouquet DB (e.g., from file or API)
+    with open('data/bouquets.json', 'rb') as bouquets_file:
+        bouquets = orjson.loads(bouquets_file.read())  # List of dicts like your sample
+
+    active_bouquets = [bouquet for bouquet in bouquets if bouquet.get('deleted_at') is None]  # Skip deleted
+
+    # Collect all texts and photos first, then encode each kind in one batched pass
+    text_entries = [text_payload(bouquet) for bouquet in active_bouquets]
+    print(f"Downloading photos for {len(active_bouquets)} bouquets")
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        photo_entries = [entry for entry in executor.map(photo_payload, active_bouquets) if entry is not None]
+
+    print(f"Embedding {len(text_entries)} texts")
+    embed_and_upsert(cached_text_encoder(batch_encoder(get_text_model(), TEXT_BATCH_SIZE)), text_entries)
+
+    print(f"Embedding {len(photo_entries)} photos")
+    embed_and_upsert(batch_encoder(get_image_model(), IMAGE_BATCH_SIZE), photo_entries)  # CLIP image encoder
+
 
-# Batch embed
-# print the progress
-for i, bouquet in enumerate(bouquets):
-    print(f"Embedding bouquet {i+1} of {len(bouquets)}")
-    if bouquet.get('deleted_at') is None:  # Skip deleted
-        embed_text(bouquet)
-        embed_photo(bouquet)
+if __name__ == "__main__":
+    main()
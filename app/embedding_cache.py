@@ -0,0 +1,96 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+import numpy as np
+
+# SQLite file holding cached embeddings
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+
+# Rows older than this are deleted, and beyond the row cap the oldest go first (~2 KB per row).
+# Pruning runs on open and again after every PRUNE_EVERY_ROWS newly written rows
+EMBEDDING_MAX_AGE_SECONDS = 30 * 86400
+EMBEDDING_MAX_ROWS = 50000
+PRUNE_EVERY_ROWS = 1000
+
+# Keys per SELECT, well under SQLite's bound-parameter limit
+LOOKUP_CHUNK_SIZE = 500
+
+
+class EmbeddingCache:
+    """Persistent cache of embeddings keyed by a hash of (model id, text or content id), safe to use from worker threads."""
+
+    def __init__(self, db_path: str = EMBEDDING_CACHE_PATH, max_age_seconds: float = EMBEDDING_MAX_AGE_SECONDS, max_rows: int = EMBEDDING_MAX_ROWS):
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.max_age_seconds = max_age_seconds
+        self.max_rows = max_rows
+        self.rows_since_prune = 0
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+        with self.lock:
+            self._prune()
+
+    def _prune(self):
+        """Delete expired rows, then the oldest ones beyond the row cap (caller holds the lock)."""
+        with self.connection:
+            self.connection.execute("DELETE FROM embeddings WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+            self.connection.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,)
+            )
+        self.rows_since_prune = 0
+
+    @staticmethod
+    def _key(model_id: str, text: str) -> bytes:
+        return hashlib.blake2b(f"{model_id}\x00{text}".encode(), digest_size=16).digest()
+
+    def _load(self, keys: List[bytes], ttl_seconds: Optional[float]) -> Dict[bytes, np.ndarray]:
+        oldest = time.time() - ttl_seconds if ttl_seconds is not None else 0.0
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+                chunk = keys[start:start + LOOKUP_CHUNK_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT key, vec FROM embeddings WHERE created_at >= ? AND key IN ({', '.join('?' * len(chunk))})",
+                    (oldest, *chunk)
+                ).fetchall()
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype=np.float32)
+        return found
+
+    def get_or_compute(self, text: str, model_id: str, encode: Callable, ttl_seconds: Optional[float] = None) -> np.ndarray:
+        """Return the embedding of one text, encoding it only on a cache miss."""
+        return self.get_or_compute_many([text], model_id, encode, ttl_seconds)[0]
+
+    def get_or_compute_many(self, texts: List[str], model_id: str, encode: Callable, ttl_seconds: Optional[float] = None) -> np.ndarray:
+        """Return embeddings for texts (one row each), passing only the cache misses to encode in one call.
+
+        encode takes a list of texts and returns one embedding per text. Entries older than
+        ttl_seconds count as misses; None keeps them forever.
+        """
+        keys = [self._key(model_id, text) for text in texts]
+        embeddings = self._load(list(dict.fromkeys(keys)), ttl_seconds)
+
+        # Encode each missing text once, even if it appears several times
+        missing = {key: text for key, text in zip(keys, texts) if key not in embeddings}
+        if missing:
+            computed = np.asarray(encode(list(missing.values())), dtype=np.float32)
+            now = time.time()
+            rows = []
+            for key, embedding in zip(missing, computed):
+                embeddings[key] = embedding
+                rows.append((key, embedding.tobytes(), now))
+            with self.lock:
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vec, created_at) VALUES (?, ?, ?)", rows)
+                self.rows_since_prune += len(rows)
+                if self.rows_since_prune >= PRUNE_EVERY_ROWS:
+                    self._prune()
+
+        return np.stack([embeddings[key] for key in keys])
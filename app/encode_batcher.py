@@ -0,0 +1,48 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List
+import numpy as np
+from .logger_config import get_logger
+
+
+class EncodeBatcher:
+    """Coalesces encode calls that arrive from several worker threads within a short window into one model call."""
+
+    def __init__(self, encode: Callable, max_wait_seconds: float):
+        self.logger = get_logger("encode_batcher")
+        self._encode = encode
+        self.max_wait_seconds = max_wait_seconds
+        self.lock = threading.Lock()
+        self.pending: List = []
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Return one embedding per text, encoded together with any texts other threads submit meanwhile."""
+        future = Future()
+        with self.lock:
+            self.pending.append((texts, future))
+            is_leader = len(self.pending) == 1
+
+        # The first caller of a window waits for company, then encodes the whole batch for everyone
+        if is_leader:
+            time.sleep(self.max_wait_seconds)
+            with self.lock:
+                batch, self.pending = self.pending, []
+            self._run(batch)
+        return future.result()
+
+    def _run(self, batch: List):
+        all_texts = [text for texts, _ in batch for text in texts]
+        try:
+            embeddings = np.asarray(self._encode(all_texts), dtype=np.float32)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        if len(batch) > 1:
+            self.logger.debug(f"Encoded {len(all_texts)} texts from {len(batch)} concurrent requests in one batch")
+        start = 0
+        for texts, future in batch:
+            future.set_result(embeddings[start:start + len(texts)])
+            start += len(texts)
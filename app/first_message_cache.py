@@ -0,0 +1,30 @@
+import re
+from cachetools import LRUCache
+from typing import Optional
+
+# Whitespace runs collapsed when normalizing messages
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+class FirstMessageCache:
+    """Reuses the reply to a conversation's first message when the same message was seen before.
+
+    Messages match only when identical after collapsing whitespace and case, so a reply is never
+    served for a message in another language or with a different meaning.
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.responses = LRUCache(maxsize=max_size)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Collapse whitespace and case, so trivially different spellings share one entry."""
+        return WHITESPACE_PATTERN.sub(' ', text).strip().casefold()
+
+    def get(self, text: str) -> Optional[str]:
+        """Return the cached reply to a first message, if any."""
+        return self.responses.get(self.normalize(text))
+
+    def put(self, text: str, response: str):
+        """Remember the reply to a first message (least recently used entries are evicted)."""
+        self.responses[self.normalize(text)] = response
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+from .logger_config import get_logger
+
+# SQLite file holding scheduled follow-ups
+FOLLOWUP_DB_PATH = os.getenv("FOLLOWUP_DB_PATH", "followups.db")
+
+
+class FollowupStore:
+    """Keeps scheduled follow-ups in SQLite so they survive restarts (queries run in worker threads)."""
+
+    def __init__(self, db_path: str = FOLLOWUP_DB_PATH):
+        self.logger = get_logger("followup_store")
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        # One connection is shared by the worker threads, so access is serialized
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS followups ("
+                "user_id INTEGER NOT NULL, followup_type TEXT NOT NULL, due_at REAL NOT NULL, "
+                "PRIMARY KEY (user_id, followup_type))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS followups_due_at ON followups (due_at)")
+        self.logger.info(f"Follow-up store opened at {db_path}")
+
+    def _execute(self, sql: str, params=()) -> list:
+        with self.lock, self.connection:
+            return self.connection.execute(sql, params).fetchall()
+
+    def _executemany(self, sql: str, rows: list):
+        with self.lock, self.connection:
+            self.connection.executemany(sql, rows)
+
+    async def schedule(self, user_id: int, due_times: Dict[str, float]):
+        """Set the due time (unix seconds) of each follow-up type for a user, replacing earlier ones."""
+        rows = [(user_id, followup_type, due_at) for followup_type, due_at in due_times.items()]
+        await asyncio.to_thread(
+            self._executemany,
+            "INSERT OR REPLACE INTO followups (user_id, followup_type, due_at) VALUES (?, ?, ?)",
+            rows
+        )
+
+    async def cancel(self, user_id: int):
+        """Drop all pending follow-ups for a user."""
+        await asyncio.to_thread(self._execute, "DELETE FROM followups WHERE user_id = ?", (user_id,))
+
+    async def remove(self, user_id: int, followup_type: str):
+        """Drop one follow-up once it has been handled."""
+        await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM followups WHERE user_id = ? AND followup_type = ?",
+            (user_id, followup_type)
+        )
+
+    async def next_due(self) -> Optional[Tuple[int, str, float]]:
+        """Return (user_id, followup_type, due_at) of the earliest pending follow-up, if any."""
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT user_id, followup_type, due_at FROM followups ORDER BY due_at LIMIT 1"
+        )
+        return rows[0] if rows else None
+
+    def close(self):
+        """Close the database connection."""
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,19 @@
+from io import BytesIO
+from PIL import Image
+
+# CLIP ViT-B/32 resizes the shorter image side to this many pixels
+CLIP_IMAGE_SIZE = 224
+
+
+def open_for_clip(image_bytes: bytes) -> Image.Image:
+    """Decode an image as RGB with its shorter side shrunk to CLIP's input size (smaller images are kept as-is)."""
+    image = Image.open(BytesIO(image_bytes))
+    # JPEGs decode straight at the smallest DCT scale that still covers CLIP's input
+    image.draft('RGB', (CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE))
+    image = image.convert('RGB')
+
+    # Finish the shrink here, so the encoder's own resize is nearly free
+    scale = CLIP_IMAGE_SIZE / min(image.size)
+    if scale < 1:
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.Resampling.BICUBIC)
+    return image
@@ -1,18 +1,31 @@
 from sentence_transformers import SentenceTransformer
-import chromadb
-import json  # Assuming your DB is a JSON list of bouquets
+import numpy as np
+from app.chroma_config import BOUQUET_COLLECTION, BOUQUET_COLLECTION_METADATA, create_client
+import orjson  # Assuming your DB is a JSON list of bouquets
 import requests
-from PIL import Image
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from app.bouquet_index import top_per_bouquet
+from app.embedding_cache import EmbeddingCache
+from app.image_utils import open_for_clip
 
-image_model = SentenceTransformer('clip-ViT-B-32')  # For images (base CLIP vision)
-client = chromadb.PersistentClient(path="./chroma_db")
-collection = client.get_or_create_collection(name="bouquets")
+IMAGE_MODEL_NAME = 'clip-ViT-B-32'
+image_model = SentenceTransformer(IMAGE_MODEL_NAME)  # For images (base CLIP vision)
+client = create_client()
+collection = client.get_or_create_collection(name=BOUQUET_COLLECTION, metadata=BOUQUET_COLLECTION_METADATA)
+embedding_cache = EmbeddingCache()
+# Keep-alive session, so repeated image URLs on the same host reuse the TLS connection;
+# transient failures are retried
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.2)))
+
+def encode_image_urls(image_urls):
+    images = [open_for_clip(http_session.get(image_url, timeout=(3, 30)).content) for image_url in image_urls]
+    return image_model.encode(images)
 
 def photo_query(image_url, min_price=None, max_price=None, k=5):
-    response = requests.get(image_url, timeout=30)
-    query_image = Image.open(BytesIO(response.content)).convert('RGB')
-    query_emb = image_model.encode(query_image).tolist()
+    # Keyed by URL, so a repeated query skips both the download and CLIP
+    query_emb = embedding_cache.get_or_compute(image_url, IMAGE_MODEL_NAME, encode_image_urls, ttl_seconds=86400)
     
     filters = []
     if min_price:
@@ -29,23 +42,15 @@ def photo_query(image_url, min_price=None, max_price=None, k=5):
         where_filter = {"$and": filters}
     
     results = collection.query(
-        query_embeddings=[query_emb],
+        query_embeddings=query_emb[None, :],  # One-row float32 array, no list conversion
         n_results=k * 2,
         where=where_filter
     )
     
-    # Similar dedupe as above, but since photo docs link to bouquets, group by bouquet_id
-    bouquet_scores = {}
-    for doc_ids, distances, metadatas in zip(results['ids'], results['distances'], results['metadatas'], strict=True):
-        for i in range(len(doc_ids)):
-            meta = metadatas[i]
-            bid = meta['bouquet_id']
-            score = 1 - distances[i]
-            if bid not in bouquet_scores or score > bouquet_scores[bid]['score']:
-                bouquet_scores[bid] = {'score': score, 'meta': meta}
-    
-    top_bouquets = sorted(bouquet_scores.values(), key=lambda x: x['score'], reverse=True)[:k]
-    return top_bouquets
+    # Similar dedupe as in text_query, since photo docs link to bouquets by bouquet_id
+    return top_per_bouquet(1 - np.asarray(results['distances'][0]), results['metadatas'][0], k)
+
 
-res = photo_query("https://imagedelivery.net/kjxkUqyuhQCleQqPHYxkVQ/a06ae574-f1a1-4a29-cc86-7a8249d97a00/public", None, None, 5)
-print(json.dumps(res, indent=4))
+if __name__ == "__main__":
+    res = photo_query("https://imagedelivery.net/kjxkUqyuhQCleQqPHYxkVQ/a06ae574-f1a1-4a29-cc86-7a8249d97a00/public", None, None, 5)
+    print(orjson.dumps(res, option=orjson.OPT_INDENT_2).decode())
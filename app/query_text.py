@@ -1,13 +1,18 @@
 from sentence_transformers import SentenceTransformer
-import chromadb
-import json  # Assuming your DB is a JSON list of bouquets
+import numpy as np
+from app.chroma_config import BOUQUET_COLLECTION, BOUQUET_COLLECTION_METADATA, create_client
+import orjson  # Assuming your DB is a JSON list of bouquets
+from app.bouquet_index import top_per_bouquet
+from app.embedding_cache import EmbeddingCache
 
-text_model = SentenceTransformer('sentence-transformers/clip-ViT-B-32-multilingual-v1')  # Multilingual CLIP
-client = chromadb.PersistentClient(path="./chroma_db")
-collection = client.get_or_create_collection(name="bouquets")
+TEXT_MODEL_NAME = 'sentence-transformers/clip-ViT-B-32-multilingual-v1'
+text_model = SentenceTransformer(TEXT_MODEL_NAME)  # Multilingual CLIP
+client = create_client()
+collection = client.get_or_create_collection(name=BOUQUET_COLLECTION, metadata=BOUQUET_COLLECTION_METADATA)
+embedding_cache = EmbeddingCache()
 
 def text_query(query_text, document_type=None, min_price=None, max_price=None, k=5):
-    query_emb = text_model.encode(query_text).tolist()
+    query_emb = embedding_cache.get_or_compute(query_text, TEXT_MODEL_NAME, text_model.encode, ttl_seconds=86400)
 
     filters = []
     if document_type:
@@ -26,25 +31,17 @@ def text_query(query_text, document_type=None, min_price=None, max_price=None, k
         where_filter = {"$and": filters}
     
     results = collection.query(
-        query_embeddings=[query_emb],
+        query_embeddings=query_emb[None, :],  # One-row float32 array, no list conversion
         n_results=2 * k,  # Oversample for dedupe
         where=where_filter,
     )
     
-    # Dedupe and rank by bouquet_id
-    bouquet_scores = {}
-    for doc_ids, distances, metadatas in zip(results['ids'], results['distances'], results['metadatas'], strict=True):
-        for i in range(len(doc_ids)):
-            meta = metadatas[i]
-            bid = meta['bouquet_id']
-            score = 1 - distances[i]  # Convert distance to similarity (cosine)
-            if bid not in bouquet_scores or score > bouquet_scores[bid]['score']:
-                bouquet_scores[bid] = {'score': score, 'meta': meta}
-    
-    top_bouquets = sorted(bouquet_scores.values(), key=lambda x: x['score'], reverse=True)[:k]
+    # Dedupe and rank by bouquet_id, converting cosine distance to similarity
+    top_bouquets = top_per_bouquet(1 - np.asarray(results['distances'][0]), results['metadatas'][0], k)
     # Fetch full bouquet JSONs from your DB using [item['meta']['bouquet_id'] for item in top_bouquets]
     return top_bouquets  # Or enriched with full data
 
 
-res = text_query("bouquet full of white roses", "text", None, None, 5)
-print(json.dumps(res, indent=4))
+if __name__ == "__main__":
+    res = text_query("bouquet full of white roses", "text", None, None, 5)
+    print(orjson.dumps(res, option=orjson.OPT_INDENT_2).decode())
@@ -1,30 +1,166 @@
-from sentence_transformers import SentenceTransformer
-import chromadb
+import hashlib
+import os
+import threading
+import time
+from cachetools import LRUCache
+from functools import cache
 from PIL import Image
+from .bouquet_index import BouquetIndex
+from .chroma_config import BOUQUET_COLLECTION, BOUQUET_COLLECTION_METADATA, create_client
+from .embedding_cache import EmbeddingCache
+from .image_utils import CLIP_IMAGE_SIZE, open_for_clip
+from .encode_batcher import EncodeBatcher
 from .logger_config import get_logger
 
 # Initialize logger
 logger = get_logger("search_tools")
 
-# Initialize models
-try:
-    logger.info("Loading sentence transformer models...")
-    text_model = SentenceTransformer('sentence-transformers/clip-ViT-B-32-multilingual-v1')
-    image_model = SentenceTransformer('clip-ViT-B-32')
-    logger.info("Models loaded successfully")
-except Exception as e:
-    logger.error(f"Failed to load models: {e}", exc_info=True)
-    raise
-
-# Initialize ChromaDB
-try:
-    logger.info("Initializing ChromaDB...")
-    client = chromadb.PersistentClient(path="./chroma_db")
-    collection = client.get_or_create_collection(name="bouquets")
-    logger.info("ChromaDB initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize ChromaDB: {e}", exc_info=True)
-    raise
+# Recent image embeddings keyed by file content hash, in front of the persistent embedding cache
+# (searches run in worker threads, hence the lock)
+IMAGE_EMBEDDING_CACHE_SIZE = 256
+image_embedding_cache = LRUCache(maxsize=IMAGE_EMBEDDING_CACHE_SIZE)
+image_embedding_lock = threading.Lock()
+
+# Recent text query embeddings keyed by query text, in front of the persistent embedding cache
+TEXT_EMBEDDING_CACHE_SIZE = 4096
+text_embedding_cache = LRUCache(maxsize=TEXT_EMBEDDING_CACHE_SIZE)
+text_embedding_lock = threading.Lock()
+
+# Inference backend for the text encoder: "torch" (default) or "onnx"/"openvino",
+# which need `pip install optimum[onnxruntime]` / `optimum[openvino]`.
+# The CLIP image encoder has no ONNX backend in sentence-transformers and always runs on torch
+TEXT_MODEL_BACKEND = os.getenv("TEXT_MODEL_BACKEND", "torch")
+TEXT_MODEL_NAME = 'sentence-transformers/clip-ViT-B-32-multilingual-v1'
+
+# CLIP_QUANT=1 runs the ONNX text encoder with INT8 dynamic quantization; the quantized
+# model is exported once into QUANTIZED_TEXT_MODEL_DIR and reused on later starts
+CLIP_QUANT = os.getenv("CLIP_QUANT") == "1"
+QUANTIZATION_CONFIG = os.getenv("CLIP_QUANT_CONFIG", "avx512_vnni")  # or "avx2", "arm64"
+QUANTIZED_TEXT_MODEL_DIR = "./models/clip-text-onnx-int8"
+
+def load_text_model():
+    """Load the multilingual CLIP text encoder with the configured backend (and quantization)."""
+    from sentence_transformers import SentenceTransformer
+
+    if not CLIP_QUANT:
+        return SentenceTransformer(TEXT_MODEL_NAME, backend=TEXT_MODEL_BACKEND)
+    if TEXT_MODEL_BACKEND != "onnx":
+        raise ValueError("CLIP_QUANT=1 requires TEXT_MODEL_BACKEND=onnx")
+
+    quantized_file = f"onnx/model_qint8_{QUANTIZATION_CONFIG}.onnx"
+    if not os.path.exists(os.path.join(QUANTIZED_TEXT_MODEL_DIR, quantized_file)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        logger.info(f"Exporting INT8 text encoder ({QUANTIZATION_CONFIG}) to {QUANTIZED_TEXT_MODEL_DIR}...")
+        onnx_model = SentenceTransformer(TEXT_MODEL_NAME, backend="onnx")
+        onnx_model.save(QUANTIZED_TEXT_MODEL_DIR)
+        export_dynamic_quantized_onnx_model(onnx_model, QUANTIZATION_CONFIG, QUANTIZED_TEXT_MODEL_DIR)
+
+    return SentenceTransformer(QUANTIZED_TEXT_MODEL_DIR, backend="onnx", model_kwargs={"file_name": quantized_file})
+
+# SentenceTransformer picks a GPU when one is available; there the torch encoders run in bfloat16,
+# or float16 on GPUs without bfloat16 (sentence-transformers upcasts the embeddings to float32 for numpy).
+# CLIP_HALF=0 keeps them in float32 for reproducible embeddings
+CLIP_HALF = os.getenv("CLIP_HALF", "1") == "1"
+
+# CLIP_COMPILE=1 compiles the torch encoders with torch.compile (slower start, faster encodes)
+CLIP_COMPILE = os.getenv("CLIP_COMPILE") == "1"
+
+# Models and the index are loaded on first use, so importing this module (e.g. for
+# generate_payment_url) doesn't pull in torch, sentence-transformers or ChromaDB
+@cache
+def half_dtype():
+    """Return the reduced-precision dtype the torch encoders run in, or None for float32."""
+    import torch
+
+    if not (CLIP_HALF and torch.cuda.is_available()):
+        return None
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+@cache
+def precision_suffix():
+    """Cache key part for the encoder precision, so float32 and half-precision vectors aren't mixed."""
+    return {"torch.bfloat16": ":bf16", "torch.float16": ":fp16"}.get(str(half_dtype()), "")
+
+@cache
+def get_text_model():
+    """Load the text encoder once, in the configured precision."""
+    try:
+        logger.info(f"Loading text model (backend: {TEXT_MODEL_BACKEND}, int8: {CLIP_QUANT}, half: {half_dtype()})...")
+        text_model = load_text_model()
+        if TEXT_MODEL_BACKEND == "torch":
+            if half_dtype() is not None:
+                text_model.to(half_dtype())
+            if CLIP_COMPILE:
+                # Compile the transformer module the model wraps; dynamic shapes avoid a recompile per text length
+                text_model[0].compile(dynamic=True)
+        logger.info("Text model loaded successfully")
+        return text_model
+    except Exception as e:
+        logger.error(f"Failed to load text model: {e}", exc_info=True)
+        raise
+
+@cache
+def get_image_model():
+    """Load the CLIP image encoder once, in the configured precision."""
+    from sentence_transformers import SentenceTransformer
+
+    try:
+        logger.info(f"Loading image model (half: {half_dtype()})...")
+        image_model = SentenceTransformer('clip-ViT-B-32')
+        if half_dtype() is not None:
+            image_model.to(half_dtype())
+        if CLIP_COMPILE:
+            image_model[0].compile(dynamic=True)
+        logger.info("Image model loaded successfully")
+        return image_model
+    except Exception as e:
+        logger.error(f"Failed to load image model: {e}", exc_info=True)
+        raise
+
+@cache
+def text_model_id():
+    """Cache key part identifying the text encoder, so backend/quantization/precision changes don't reuse stale vectors."""
+    model_id = f"{TEXT_MODEL_NAME}:{TEXT_MODEL_BACKEND}{':int8-' + QUANTIZATION_CONFIG if CLIP_QUANT else ''}"
+    return model_id + precision_suffix() if TEXT_MODEL_BACKEND == "torch" else model_id
+
+@cache
+def image_model_id():
+    """Cache key part identifying the image encoder."""
+    return f"clip-ViT-B-32{precision_suffix()}"
+
+# Query embeddings are kept for a day, so queries repeated across users and restarts skip the encoder.
+# Image embeddings are keyed by content hash, so they never go stale and are kept without a TTL
+QUERY_EMBEDDING_TTL_SECONDS = 86400
+
+@cache
+def get_embedding_cache():
+    """Open the persistent embedding cache on first use, not at import."""
+    return EmbeddingCache()
+
+# Text queries that miss the cache within this window of each other are encoded in one batch
+TEXT_ENCODE_MAX_WAIT_SECONDS = 0.015
+TEXT_ENCODE_BATCH_SIZE = 32
+text_encode_batcher = EncodeBatcher(
+    lambda texts: get_text_model().encode(texts, batch_size=TEXT_ENCODE_BATCH_SIZE, convert_to_numpy=True),
+    TEXT_ENCODE_MAX_WAIT_SECONDS
+)
+
+@cache
+def get_bouquet_index():
+    """Load the bouquet collection from ChromaDB into the in-memory index once."""
+    try:
+        logger.info("Initializing ChromaDB...")
+        client = create_client()
+        collection = client.get_or_create_collection(name=BOUQUET_COLLECTION, metadata=BOUQUET_COLLECTION_METADATA)
+        # The catalog is small and changes only on re-ingest, so queries run against an in-memory copy
+        # (restart the bot after running app.embed to pick up changes)
+        bouquet_index = BouquetIndex(collection)
+        logger.info("ChromaDB initialized successfully")
+        return bouquet_index
+    except Exception as e:
+        logger.error(f"Failed to initialize ChromaDB: {e}", exc_info=True)
+        raise
 
 def search_products_by_text(query_text, document_type=None, min_price=None, max_price=None, k=5):
     """
@@ -43,46 +179,11 @@ def search_products_by_text(query_text, document_type=None, min_price=None, max_
     try:
         logger.info(f"Starting text search: '{query_text[:50]}...', filters: doc_type={document_type}, min_price={min_price}, max_price={max_price}, k={k}")
         
-        query_emb = text_model.encode(query_text).tolist()
-        logger.debug(f"Generated query embedding with {len(query_emb)} dimensions")
-
-        filters = []
-        if document_type:
-            filters.append({"type": {"$eq": document_type}})
-        if min_price:
-            filters.append({"price": {"$gte": min_price}})
-        if max_price:
-            filters.append({"price": {"$lte": max_price}})
-        
-        # Build where_filter based on number of filters
-        if not filters:
-            where_filter = None  # CHANGE: Use None instead of {}
-        elif len(filters) == 1:
-            where_filter = filters[0]
-        else:
-            where_filter = {"$and": filters}
-        
-        logger.debug(f"Using where_filter: {where_filter}")
-        
-        results = collection.query(
-            query_embeddings=[query_emb],
-            n_results=2 * k,  # Oversample for dedupe
-            where=where_filter,
-        )
-        
-        logger.debug(f"ChromaDB returned {len(results['ids'][0])} raw results")
-        
-        # Dedupe and rank by bouquet_id
-        bouquet_scores = {}
-        for doc_ids, distances, metadatas in zip(results['ids'], results['distances'], results['metadatas'], strict=True):
-            for i in range(len(doc_ids)):
-                meta = metadatas[i]
-                bid = meta['bouquet_id']
-                score = 1 - distances[i]  # Convert distance to similarity (cosine)
-                if bid not in bouquet_scores or score > bouquet_scores[bid]['score']:
-                    bouquet_scores[bid] = {'score': score, 'meta': meta}
-        
-        top_bouquets = sorted(bouquet_scores.values(), key=lambda x: x['score'], reverse=True)[:k]
+        query_emb = encode_query_text(query_text)
+        logger.debug(f"Query embedding has {len(query_emb)} dimensions")
+
+        # Exact search over the in-memory index; it keeps the best document per bouquet
+        top_bouquets = get_bouquet_index().search(query_emb, document_type=document_type, min_price=min_price, max_price=max_price, k=k)
         logger.info(f"Text search completed: found {len(top_bouquets)} unique bouquets")
         return top_bouquets
         
@@ -90,12 +191,57 @@ def search_products_by_text(query_text, document_type=None, min_price=None, max_
         logger.error(f"Error in text search: {e}", exc_info=True)
         raise
 
-def search_products_by_photo(photo_path, min_price=None, max_price=None, k=5):
+def encode_query_text(query_text):
+    """Return the CLIP embedding for a text query, from memory for recent queries and the persistent cache after that."""
+    # Collapse whitespace so trivially different spellings of a query share one entry
+    query_key = ' '.join(query_text.split())
+    with text_embedding_lock:
+        cached_emb = text_embedding_cache.get(query_key)
+    if cached_emb is not None:
+        return cached_emb
+
+    query_emb = get_embedding_cache().get_or_compute(
+        query_key, text_model_id(), text_encode_batcher.encode, ttl_seconds=QUERY_EMBEDDING_TTL_SECONDS
+    )
+    with text_embedding_lock:
+        text_embedding_cache[query_key] = query_emb
+    return query_emb
+
+def encode_photo(photo):
+    """Return the CLIP embedding for an image (file path or raw bytes), reusing it when the same image is sent again."""
+    if isinstance(photo, bytes):
+        image_bytes = photo
+    else:
+        with open(photo, 'rb') as f:
+            image_bytes = f.read()
+    digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+    with image_embedding_lock:
+        cached_emb = image_embedding_cache.get(digest)
+    if cached_emb is not None:
+        logger.debug(f"Reusing cached image embedding {digest}")
+        return cached_emb
+
+    def encode_image(_digests):
+        # Load and shrink the image to CLIP's input size before the encoder sees it
+        query_image = open_for_clip(image_bytes)
+        logger.debug(f"Loaded image: {query_image.size}")
+        return get_image_model().encode([query_image])
+
+    # The persistent cache keeps the embedding across restarts, so a resent photo skips CLIP
+    query_emb = get_embedding_cache().get_or_compute(digest, image_model_id(), encode_image)
+    logger.debug(f"Image embedding has {len(query_emb)} dimensions")
+
+    with image_embedding_lock:
+        image_embedding_cache[digest] = query_emb
+    return query_emb
+
+def search_products_by_photo(photo, min_price=None, max_price=None, k=5):
     """
-    Search for products using image file with filters.
+    Search for products using an image with filters.
     
     Args:
-        photo_path (str): Path to the image file
+        photo (str or bytes): Path to the image file, or the image bytes
         min_price (float, optional): Minimum price filter
         max_price (float, optional): Maximum price filter
         k (int): Number of results to return
@@ -104,50 +250,13 @@ def search_products_by_photo(photo_path, min_price=None, max_price=None, k=5):
         list: List of product results with metadata
     """
     try:
-        logger.info(f"Starting photo search: {photo_path}, filters: min_price={min_price}, max_price={max_price}, k={k}")
-        
-        # Load and process image
-        query_image = Image.open(photo_path).convert('RGB')
-        logger.debug(f"Loaded image: {query_image.size}")
-        
-        query_emb = image_model.encode(query_image).tolist()
-        logger.debug(f"Generated image embedding with {len(query_emb)} dimensions")
-        
-        filters = []
-        if min_price:
-            filters.append({"price": {"$gte": min_price}})
-        if max_price:
-            filters.append({"price": {"$lte": max_price}})
-        
-        # Build where_filter based on number of filters
-        if not filters:
-            where_filter = None  # CHANGE: Use None instead of {}
-        elif len(filters) == 1:
-            where_filter = filters[0]
-        else:
-            where_filter = {"$and": filters}
-        
-        logger.debug(f"Using where_filter: {where_filter}")
-        
-        results = collection.query(
-            query_embeddings=[query_emb],
-            n_results=k * 2,
-            where=where_filter
-        )
+        photo_label = f"{len(photo)} bytes" if isinstance(photo, bytes) else photo
+        logger.info(f"Starting photo search: {photo_label}, filters: min_price={min_price}, max_price={max_price}, k={k}")
         
-        logger.debug(f"ChromaDB returned {len(results['ids'][0])} raw results")
+        query_emb = encode_photo(photo)
         
-        # Similar dedupe as above, but since photo docs link to bouquets, group by bouquet_id
-        bouquet_scores = {}
-        for doc_ids, distances, metadatas in zip(results['ids'], results['distances'], results['metadatas'], strict=True):
-            for i in range(len(doc_ids)):
-                meta = metadatas[i]
-                bid = meta['bouquet_id']
-                score = 1 - distances[i]
-                if bid not in bouquet_scores or score > bouquet_scores[bid]['score']:
-                    bouquet_scores[bid] = {'score': score, 'meta': meta}
-        
-        top_bouquets = sorted(bouquet_scores.values(), key=lambda x: x['score'], reverse=True)[:k]
+        # Photo docs link to bouquets, so results are grouped by bouquet_id the same way
+        top_bouquets = get_bouquet_index().search(query_emb, min_price=min_price, max_price=max_price, k=k)
         logger.info(f"Photo search completed: found {len(top_bouquets)} unique bouquets")
         return top_bouquets
         
@@ -155,6 +264,14 @@ def search_products_by_photo(photo_path, min_price=None, max_price=None, k=5):
         logger.error(f"Error in photo search: {e}", exc_info=True)
         raise
 
+def warm_up():
+    """Run one throwaway encode per model and one index search, so the first user doesn't pay for cold kernels."""
+    started = time.perf_counter()
+    get_text_model().encode(["warm-up"])
+    query_emb = get_image_model().encode([Image.new('RGB', (CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE))])[0]
+    get_bouquet_index().search(query_emb, k=1)
+    logger.info(f"Search models warmed up in {time.perf_counter() - started:.2f}s")
+
 def format_price(price):
     """Format price from smallest currency units to readable format."""
     return f"{price / 1000:.2f}"
@@ -169,21 +286,14 @@ def get_product_description(meta, language='en'):
     desc_data = meta.get('description', {})
     return desc_data.get(language, desc_data.get('en', 'No description available'))
 
+# Click payment URL with every parameter but the amount fixed. return_url stays unencoded:
+# the bot's PAYMENT_URL_PATTERN looks for it verbatim to attach the payment button
+PAYMENT_URL_TEMPLATE = (
+    "https://my.click.uz/services/pay/"
+    "?service_id=30067&merchant_id=22535&amount={:.2f}"
+    "&transaction_param=165884&return_url=https://t.me/easify_seller_bot"
+)
+
 def generate_payment_url(price):
     """Generate Click payment URL with the specified amount."""
-    # Base URL with fixed parameters
-    base_url = "https://my.click.uz/services/pay/"
-    
-    # Fixed parameters
-    service_id = "30067"
-    merchant_id = "22535"
-    transaction_param = "165884"
-    return_url = "https://t.me/easify_seller_bot"
-    
-    # Format amount to 2 decimal places
-    amount = f"{price:.2f}"
-    
-    # Build the complete URL
-    payment_url = f"{base_url}?service_id={service_id}&merchant_id={merchant_id}&amount={amount}&transaction_param={transaction_param}&return_url={return_url}"
-    
-    return payment_url
+    return PAYMENT_URL_TEMPLATE.format(price)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Test script for the in-memory bouquet index and its one-hit-per-bouquet ranking
+"""
+
+import numpy as np
+from app.bouquet_index import BouquetIndex, top_per_bouquet
+
+
+class FakeCollection:
+    """Stands in for a ChromaDB collection, returning fixed documents from get()."""
+
+    def __init__(self, embeddings, metadatas):
+        self.embeddings = embeddings
+        self.metadatas = metadatas
+
+    def get(self, include):
+        return {"embeddings": self.embeddings, "metadatas": self.metadatas}
+
+
+# Bouquet 1 has a text and a photo document; bouquets 2 and 3 have one document each
+EMBEDDINGS = [
+    [1.0, 0.0],
+    [0.9, 0.1],
+    [0.8, 0.2],
+    [0.0, 1.0],
+]
+METADATAS = [
+    {"bouquet_id": 1, "type": "text", "price": 300000},
+    {"bouquet_id": 1, "type": "photo", "price": 300000},
+    {"bouquet_id": 2, "type": "photo", "price": 500000},
+    {"bouquet_id": 3, "type": "text", "price": 200000},
+]
+
+
+def test_top_per_bouquet():
+    """Test that each bouquet keeps only its best hit, best first."""
+    results = top_per_bouquet([0.5, 0.9, 0.7, 0.1], METADATAS, k=5)
+    assert [result["meta"]["bouquet_id"] for result in results] == [1, 2, 3]
+    assert results[0]["meta"]["type"] == "photo"
+    assert results[0]["score"] == 0.9
+
+    assert len(top_per_bouquet([0.5, 0.9, 0.7, 0.1], METADATAS, k=2)) == 2
+    print("✅ top_per_bouquet keeps one hit per bouquet")
+
+
+def test_bouquet_index_search():
+    """Test ranking, per-bouquet dedupe and the type and price filters."""
+    index = BouquetIndex(FakeCollection(EMBEDDINGS, METADATAS))
+
+    # Bouquet 1 matches twice but is returned once, with its best document
+    results = index.search([1.0, 0.0], k=5)
+    assert [result["meta"]["bouquet_id"] for result in results] == [1, 2, 3]
+    assert results[0]["meta"]["type"] == "text"
+    assert np.isclose(results[0]["score"], 1.0)
+
+    # k counts bouquets, not documents
+    assert [result["meta"]["bouquet_id"] for result in index.search([1.0, 0.0], k=2)] == [1, 2]
+
+    results = index.search([1.0, 0.0], document_type="photo", k=5)
+    assert [(result["meta"]["bouquet_id"], result["meta"]["type"]) for result in results] == [(1, "photo"), (2, "photo")]
+
+    results = index.search([1.0, 0.0], min_price=250000, max_price=400000, k=5)
+    assert [result["meta"]["bouquet_id"] for result in results] == [1]
+
+    assert BouquetIndex(FakeCollection([], [])).search([1.0, 0.0]) == []
+    print("✅ BouquetIndex ranks, dedupes and filters bouquets correctly")
+
+
+if __name__ == "__main__":
+    test_top_per_bouquet()
+    test_bouquet_index_search()
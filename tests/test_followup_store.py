@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Test script for the SQLite follow-up store
+"""
+
+import asyncio
+from app.followup_store import FollowupStore
+
+
+async def check_followup_store():
+    store = FollowupStore(":memory:")
+    try:
+        assert await store.next_due() is None
+
+        # The earliest due follow-up comes first, across users
+        await store.schedule(1, {"20sec": 120.0, "5min": 400.0})
+        await store.schedule(2, {"20sec": 100.0})
+        assert await store.next_due() == (2, "20sec", 100.0)
+
+        # Rescheduling replaces a user's earlier due time instead of adding a second row
+        await store.schedule(2, {"20sec": 500.0})
+        assert await store.next_due() == (1, "20sec", 120.0)
+
+        # Removing a handled follow-up keeps the user's others
+        await store.remove(1, "20sec")
+        assert await store.next_due() == (1, "5min", 400.0)
+
+        # Cancelling drops every follow-up of that user only
+        await store.cancel(1)
+        assert await store.next_due() == (2, "20sec", 500.0)
+        await store.cancel(2)
+        assert await store.next_due() is None
+    finally:
+        store.close()
+
+
+def test_followup_store():
+    """Test scheduling, rescheduling, removing and cancelling follow-ups."""
+    asyncio.run(check_followup_store())
+    print("✅ Follow-up store schedules, orders and cancels follow-ups correctly")
+
+
+if __name__ == "__main__":
+    test_followup_store()
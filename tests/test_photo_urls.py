@@ -4,8 +4,14 @@ Test script to verify photo URLs are accessible
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from app.search_tools import search_products_by_text
 
+# One keep-alive session for all checks, retrying transient failures
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.2)))
+
 def test_photo_urls():
     """Test if photo URLs are accessible."""
     print("🖼️ Testing photo URL accessibility...")
@@ -33,7 +39,7 @@ def test_photo_urls():
             print(f"Photo URL: {photo_url}")
             
             try:
-                response = requests.head(photo_url, timeout=10)
+                response = http_session.head(photo_url, timeout=(3, 10))
                 if response.status_code == 200:
                     print(f"✅ Photo accessible (status: {response.status_code})")
                 else: